@@ -0,0 +1,90 @@
+"""
+gaussian_blur against PIL's GaussianBlur, on the images we blur while rendering:
+full frame layers (node shadows, graph lines), note pulse masks, and chord line and ball sprites.
+
+    python benchmarks/bench_blur.py
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.blur_stuff import blur_padding, gaussian_blur  # noqa: E402
+from src.frame_stuff import premultiply  # noqa: E402
+
+FRAME_SIZE = (1088, 1920)
+
+
+def frame_layer(radius):
+    """A transparent full frame with a few shapes on it, like the node shadows layer"""
+    image = Image.new("RGBA", FRAME_SIZE, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for x, y in [(300, 500), (700, 700), (500, 1200), (250, 1500)]:
+        draw.ellipse([x - 60, y - 60, x + 60, y + 60], fill=(128, 128, 128, 255))
+    return image
+
+
+def pulse_mask(radius):
+    """A note pulse mask, padded for its blur like in animate_ellipsis_blur"""
+    size = 2 * (60 + blur_padding(radius))
+    image = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(image).ellipse(
+        [size / 2 - 60, size / 2 - 60, size / 2 + 60, size / 2 + 60], fill=255
+    )
+    return image
+
+
+def time_blur(blur, image, radius, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = blur(image, radius)
+    elapsed = (time.perf_counter() - start) / runs
+
+    result = np.asarray(result)
+    if image.mode == "RGBA":
+        # Colors under (almost) transparent pixels don't show, compare what gets composited
+        result = premultiply(result)
+    return elapsed, result.astype(int)
+
+
+@click.command()
+@click.option(
+    "--runs",
+    type=click.IntRange(min=1),
+    help="Number of times each blur is run.",
+    default=10,
+)
+def main(runs):
+    cases = [
+        ("frame layer", frame_layer, 5),
+        ("frame layer", frame_layer, 10),
+        ("frame layer", frame_layer, 30),
+        ("pulse mask", pulse_mask, 5),
+        ("pulse mask", pulse_mask, 10),
+        ("pulse mask", pulse_mask, 30),
+        ("pulse mask", pulse_mask, 64),
+        ("pulse mask", pulse_mask, 127),
+    ]
+    for name, create_image, radius in cases:
+        image = create_image(radius)
+        pil_time, expected = time_blur(
+            lambda image, radius: image.filter(ImageFilter.GaussianBlur(radius)),
+            image,
+            radius,
+            runs,
+        )
+        fast_time, result = time_blur(gaussian_blur, image, radius, runs)
+        click.echo(
+            f"{name:>12} {image.width}x{image.height} radius {radius:>3}: "
+            f"PIL {pil_time * 1000:7.2f}ms, gaussian_blur {fast_time * 1000:7.2f}ms "
+            f"({pil_time / fast_time:.1f}x), max difference {np.abs(result - expected).max()}"
+        )
+
+
+if __name__ == "__main__":
+    main()
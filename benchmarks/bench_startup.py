@@ -0,0 +1,115 @@
+"""
+Cold start times of music_graphs.py, each run in a fresh interpreter:
+--help, --validate_theme, and a one frame render once the note and layout caches are warm.
+Also checks that --help doesn't import the heavy dependencies.
+
+    python benchmarks/bench_startup.py --midi examples/wii-music.mid
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only rendering needs these, --help must start without them
+HEAVY_MODULES = ["numpy", "PIL"]
+
+# Runs --help in-process, then prints the heavy modules it imported
+CHECK_HELP_IMPORTS = f"""
+import sys
+sys.argv = ["music_graphs.py", "--help"]
+try:
+    import music_graphs
+    music_graphs.main()
+except SystemExit:
+    pass
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules), file=sys.stderr)
+"""
+
+
+def heavy_modules_imported_by_help():
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK_HELP_IMPORTS],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    return [m for m in result.stderr.strip().split(",") if m]
+
+
+def time_command(args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "music_graphs.py", *args],
+            cwd=ROOT,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+@click.command()
+@click.option(
+    "--midi",
+    type=click.Path(exists=True),
+    help="MIDI file for the cached render, skipped if not given.",
+    default=None,
+)
+@click.option(
+    "--runs",
+    type=click.IntRange(min=1),
+    help="Number of times each command is run.",
+    default=5,
+)
+def main(midi, runs):
+    heavy_modules = heavy_modules_imported_by_help()
+    if heavy_modules:
+        raise click.ClickException(
+            f"--help imports {', '.join(heavy_modules)}, it should start without them"
+        )
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        one_frame_theme = os.path.join(temp_dir, "theme.yaml")
+        with open(one_frame_theme, "w") as f:
+            f.write("debug:\n  max_frames: 1\n")
+
+        commands = {
+            "--help": ["--help"],
+            "--validate_theme": ["--validate_theme", "--dark"],
+        }
+        if midi:
+            render = [
+                "--midi",
+                os.path.abspath(midi),
+                "--dark",
+                "--theme",
+                one_frame_theme,
+                "--encoder",
+                "png",
+                "--output_filename",
+                os.path.join(temp_dir, "frames"),
+            ]
+            # Fill the note and layout caches first
+            time_command(render, 1)
+            commands["cached render"] = render
+
+        for name, args in commands.items():
+            times = time_command(args, runs)
+            click.echo(
+                f"{name:>20}: min {min(times):.3f}s, median {statistics.median(times):.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
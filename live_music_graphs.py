@@ -0,0 +1,97 @@
+import click
+
+from src.encoder_stuff import create_encoder
+from src.live_stuff import (
+    DEFAULT_LATENCY,
+    LiveRenderer,
+    replay_midi_file,
+    socket_note_events,
+)
+from src.options_stuff import STREAM_ENCODERS
+from src.theme_stuff import DARK_THEME_FILE, LIGHT_THEME_FILE, Theme, ThemeError
+
+
+@click.command()
+@click.option(
+    "--theme",
+    type=click.Path(exists=True),
+    help="Path to a YAML theme file.",
+)
+@click.option(
+    "--dark",
+    type=bool,
+    help="True if dark theme should be the used.",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--replay",
+    type=click.Path(exists=True),
+    help="Play a MIDI file in real time, instead of listening for notes.",
+    default=None,
+)
+@click.option(
+    "--speed",
+    type=float,
+    help="Playback speed of --replay.",
+    default=1.0,
+)
+@click.option(
+    "--listen",
+    type=int,
+    help='Port to listen on for notes, sent as JSON lines like {"pitch": 60, "velocity": 100}.',
+    default=None,
+)
+@click.option(
+    "--latency",
+    type=float,
+    help="Seconds between a note being played and drawn.",
+    default=DEFAULT_LATENCY,
+)
+@click.option(
+    "--encoder",
+    type=click.Choice(STREAM_ENCODERS),
+    help="Format of the frames written to stdout.",
+    default="y4m",
+)
+def main(theme, dark, replay, speed, listen, latency, encoder):
+    if (replay is None) == (listen is None):
+        raise click.UsageError("Use one of --replay or --listen")
+
+    default_theme_file = LIGHT_THEME_FILE
+    if dark:
+        default_theme_file = DARK_THEME_FILE
+
+    if not theme:
+        theme = default_theme_file
+
+    theme = Theme(theme, default_theme_file)
+
+    click.echo("Creating Graph...", err=True)
+    try:
+        renderer = LiveRenderer(theme, latency=latency)
+    except ThemeError as e:
+        raise click.ClickException(str(e))
+    writer = create_encoder(encoder, renderer.size, theme.frame_rate)
+
+    if replay:
+        events = replay_midi_file(replay, speed=speed)
+    else:
+        click.echo(f"Listening for notes on port {listen}...", err=True)
+        events = socket_note_events(port=listen)
+
+    try:
+        renderer.run(events, lambda frame_index, frame: writer.write_frame(frame))
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        writer.close()
+
+    click.echo(
+        f"Drew {renderer.frames_drawn} frames, repeated {renderer.frames_skipped} to keep up",
+        err=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
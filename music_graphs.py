@@ -1,10 +1,37 @@
+import json
 import os
 
 import click
 
-from src.generate_music_graph import generate_music_graph
-from src.midi_stuff import SOUND_FONT_FILE
-from src.theme_stuff import DARK_THEME_FILE, LIGHT_THEME_FILE
+from src.memory_stuff import parse_memory_size
+from src.options_stuff import (
+    DEFAULT_CODEC,
+    DEFAULT_CRF,
+    DEFAULT_PRESET,
+    ENCODERS,
+    SOUND_FONT_FILE,
+    STREAM_ENCODERS,
+    check_resolutions,
+    parse_resolution,
+)
+from src.telemetry_stuff import DEFAULT_TELEMETRY_INTERVAL, Telemetry
+from src.theme_stuff import DARK_THEME_FILE, LIGHT_THEME_FILE, Theme, ThemeError
+
+
+def validate_memory_size(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_memory_size(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def validate_resolutions(ctx, param, value):
+    try:
+        return [parse_resolution(resolution) for resolution in value]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 def get_filename_without_extension(path):
@@ -16,9 +43,8 @@ def get_filename_without_extension(path):
 @click.command()
 @click.option(
     "--midi",
-    required=True,
     type=click.Path(exists=True),
-    help="Path to a MIDI file.",
+    help="Path to a MIDI file, required unless --validate_theme is used.",
 )
 @click.option(
     "--theme",
@@ -44,7 +70,111 @@ def get_filename_without_extension(path):
     help="Path to a Soundfont file",
     default=SOUND_FONT_FILE,
 )
-def main(midi, theme, output_filename, soundfont_file, dark):
+@click.option(
+    "--encoder",
+    type=click.Choice(ENCODERS),
+    help="ffmpeg writes an MP4, y4m/rgb/rgba stream frames to stdout, png/qoi write an image sequence.",
+    default="ffmpeg",
+)
+@click.option(
+    "--codec",
+    help="Video codec used by the ffmpeg encoder.",
+    default=DEFAULT_CODEC,
+)
+@click.option(
+    "--preset",
+    help="Encoder preset, e.g. ultrafast for drafts or slow for finals.",
+    default=DEFAULT_PRESET,
+)
+@click.option(
+    "--crf",
+    type=int,
+    help="Constant Rate Factor used by the ffmpeg encoder (lower is better quality).",
+    default=DEFAULT_CRF,
+)
+@click.option(
+    "--encoder_threads",
+    type=int,
+    help="Number of threads used by the ffmpeg encoder (0 = automatic).",
+    default=0,
+)
+@click.option(
+    "--max_memory",
+    help="Memory budget, e.g. 2G. Bounds the frames in flight and spills the frame plan to disk.",
+    default=None,
+    callback=validate_memory_size,
+)
+@click.option(
+    "--frame_cache_size",
+    help="Keep up to this much of drawn frames on disk, e.g. 4G. Re-renders only draw the frames that changed.",
+    default=None,
+    callback=validate_memory_size,
+)
+@click.option(
+    "--resolution",
+    help="Output size, e.g. 540x960. Repeat it to get several sizes out of one render, "
+    "the frames are drawn once at the theme's size and scaled down. Sizes must keep the theme's "
+    "aspect ratio. Defaults to the theme's size.",
+    multiple=True,
+    callback=validate_resolutions,
+)
+@click.option(
+    "--dry_run",
+    type=bool,
+    help="Plan the song without drawing it, and print a JSON report of the frames, layers, "
+    "draws, estimated peak memory and estimated drawing time.",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--calibrate",
+    type=bool,
+    help="A --dry_run that first draws a sample of the frames, to measure the draw costs on this machine. "
+    "Later dry runs use the measured costs.",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--telemetry",
+    "telemetry_path",
+    type=click.Path(),
+    help="Append structured progress events (stages, frames per second, cache hit rates, memory) "
+    "to this file, as JSON lines.",
+    default=None,
+)
+@click.option(
+    "--telemetry_interval",
+    type=click.FloatRange(min=0),
+    help="Seconds between the progress events written to --telemetry.",
+    default=DEFAULT_TELEMETRY_INTERVAL,
+)
+@click.option(
+    "--validate_theme",
+    type=bool,
+    help="Check the theme file for mistakes and exit, without rendering.",
+    default=False,
+    is_flag=True,
+)
+def main(
+    midi,
+    theme,
+    output_filename,
+    soundfont_file,
+    dark,
+    encoder,
+    codec,
+    preset,
+    crf,
+    encoder_threads,
+    max_memory,
+    frame_cache_size,
+    resolution,
+    dry_run,
+    calibrate,
+    telemetry_path,
+    telemetry_interval,
+    validate_theme,
+):
     default_theme_file = LIGHT_THEME_FILE
     if dark:
         default_theme_file = DARK_THEME_FILE
@@ -52,16 +182,86 @@ def main(midi, theme, output_filename, soundfont_file, dark):
     if not theme:
         theme = default_theme_file
 
+    if validate_theme:
+        try:
+            Theme(theme, default_theme_file).validate()
+        except ThemeError as e:
+            raise click.ClickException(str(e))
+        click.echo(f"{theme} is valid", err=True)
+        return
+
+    if not midi:
+        raise click.UsageError("Missing option '--midi'.")
+
+    if resolution:
+        try:
+            theme_settings = Theme(theme, default_theme_file)
+            check_resolutions(
+                resolution, (theme_settings.width, theme_settings.height), encoder
+            )
+        except ThemeError as e:
+            raise click.ClickException(str(e))
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="'--resolution'")
+        if len(resolution) > 1 and encoder in STREAM_ENCODERS:
+            raise click.BadParameter(
+                f"The {encoder} encoder can only stream one resolution",
+                param_hint="'--resolution'",
+            )
+
+    # Rendering needs the heavy dependencies, --help and --validate_theme don't
+    from src.encoder_stuff import check_encoder
+    from src.generate_music_graph import Renderer, echo_progress, generate_music_graph
+    from src.smf_stuff import MidiFileError
+
+    try:
+        check_encoder(encoder)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="'--encoder'")
+
+    telemetry = Telemetry(telemetry_path, interval=telemetry_interval)
+
+    if dry_run or calibrate:
+        try:
+            with telemetry, Renderer(
+                on_progress=echo_progress, telemetry=telemetry
+            ) as renderer:
+                report = renderer.dry_run(
+                    midi,
+                    default_theme_file,
+                    theme,
+                    max_memory=max_memory,
+                    calibrate_costs=calibrate,
+                )
+        except (MidiFileError, ThemeError) as e:
+            raise click.ClickException(str(e))
+        click.echo("", err=True)
+        click.echo(json.dumps(report, indent=2))
+        return
+
     if not output_filename:
         output_filename = get_filename_without_extension(midi)
 
-    generate_music_graph(
-        midi,
-        default_theme_file,
-        theme,
-        output_filename,
-        soundfont_file,
-    )
+    try:
+        with telemetry:
+            generate_music_graph(
+                midi,
+                default_theme_file,
+                theme,
+                output_filename,
+                soundfont_file,
+                encoder=encoder,
+                codec=codec,
+                preset=preset,
+                crf=crf,
+                encoder_threads=encoder_threads,
+                max_memory=max_memory,
+                frame_cache_size=frame_cache_size,
+                resolutions=resolution,
+                telemetry=telemetry,
+            )
+    except (MidiFileError, ThemeError) as e:
+        raise click.ClickException(str(e))
 
 
 if __name__ == "__main__":
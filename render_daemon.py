@@ -0,0 +1,64 @@
+import click
+
+from src.daemon_stuff import (
+    DEFAULT_PORT,
+    DEFAULT_WORKERS,
+    RenderService,
+    create_server,
+)
+from src.telemetry_stuff import DEFAULT_TELEMETRY_INTERVAL, Telemetry
+
+
+@click.command()
+@click.option(
+    "--port",
+    type=int,
+    help="Port to serve on, on localhost only.",
+    default=DEFAULT_PORT,
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(),
+    help="Serve on a Unix socket at this path, instead of a port.",
+    default=None,
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    help="Number of songs rendered at the same time.",
+    default=DEFAULT_WORKERS,
+)
+@click.option(
+    "--telemetry",
+    "telemetry_path",
+    type=click.Path(),
+    help="Append structured job and render events to this file, as JSON lines.",
+    default=None,
+)
+@click.option(
+    "--telemetry_interval",
+    type=click.FloatRange(min=0),
+    help="Seconds between the progress events of each render.",
+    default=DEFAULT_TELEMETRY_INTERVAL,
+)
+def main(port, socket_path, workers, telemetry_path, telemetry_interval):
+    telemetry = Telemetry(telemetry_path, interval=telemetry_interval)
+    service = RenderService(num_workers=workers, telemetry=telemetry)
+    server = create_server(service, port=port, socket_path=socket_path)
+    click.echo(
+        f"Rendering with {workers} workers on {socket_path or f'http://127.0.0.1:{port}'}",
+        err=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        telemetry.close()
+
+
+if __name__ == "__main__":
+    main()
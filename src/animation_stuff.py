@@ -1,43 +1,162 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from src.memory_stuff import PLAN_BYTES_PER_ANIMATION
+
+# Animations are indexed by the buckets of frames they overlap, so a frame only looks at a few of them
+FRAMES_PER_BUCKET = 64
+
+
 class AnimationFrames:
     """
-    Helper object to organize layered frames in order to produce an animation.
-    self._data is a Dict.  The Keys are "layer_ids", and the values are Lists of "images".
-    They are not really images, they are instead closures that can be executed to create an image.
+    Helper object to organize layered animations in order to produce frames.
+    Only one descriptor is stored per animation: (layer_id, start_frame, end_frame, draw_function, {kwargs}).
+    The [draw_function, {kwargs}] pairs of a frame are resolved when it is drawn, by adding the frame_number
+    relative to the start of each animation playing on that frame.
+    When animations overlap on the same layer, the one added last wins.
+    Buckets that planning is done with can be spilled to disk as the song is planned, see `spill_as_planned`,
+    and are then loaded back as they are drawn.
     """
 
     def __init__(self):
-        self._data = {}
+        self._animations = []
+        self._num_animations = 0
+        self._length = 0
+        self._buckets = {}
+        self._spill_directory = None
+        self._should_spill = None
+        self._loaded_buckets = OrderedDict()
+        self._lock = threading.Lock()
 
     def __len__(self):
-        if not len(self._data):
-            return 0
-        first_layer = list(self._data.keys())[0]
-        return len(self._data[first_layer])
+        return self._length
+
+    @property
+    def num_animations(self):
+        """Every animation planned, including the ones spilled to disk"""
+        return self._num_animations
+
+    @property
+    def estimated_size(self):
+        """Rough size of the animations held in memory"""
+        return len(self._animations) * PLAN_BYTES_PER_ANIMATION
+
+    def add_animation(self, layer_id, start_frame, length, draw_function, kwargs):
+        """Play `draw_function` on a layer for `length` frames, it is called with frame_number 0 to length - 1"""
+        self._length = max(self._length, start_frame + length)
+        if length <= 0:
+            return
+        animation = (layer_id, start_frame, start_frame + length, draw_function, kwargs)
+        self._animations.append(animation)
+        self._num_animations += 1
+        self._add_to_buckets(animation)
+
+    def _add_to_buckets(self, animation):
+        # Buckets keep the animations in the order they were added, so later ones can win.
+        # They are filled in as animations are added, so frames can be drawn while the song is still being planned
+        _, start_frame, end_frame, _, _ = animation
+        for bucket_index in range(
+            start_frame // FRAMES_PER_BUCKET,
+            (end_frame - 1) // FRAMES_PER_BUCKET + 1,
+        ):
+            self._buckets.setdefault(bucket_index, []).append(animation)
+
+    def merge(self, other):
+        """Add the animations of another plan, e.g. one planned for a single track in a worker process"""
+        for animation in other._animations:
+            self._animations.append(animation)
+            self._add_to_buckets(animation)
+        self._num_animations += other._num_animations
+        self._length = max(self._length, other._length)
+
+    def drop_frames_before(self, frame_index):
+        """Forget the animations that ended before `frame_index`, so a live plan doesn't grow forever"""
+        for bucket_index in [
+            b for b in self._buckets if b < frame_index // FRAMES_PER_BUCKET
+        ]:
+            del self._buckets[bucket_index]
+        self._animations = [a for a in self._animations if a[2] > frame_index]
+
+    def __getstate__(self):
+        # Locks can't be pickled, plans are sent back from worker processes
+        state = self.__dict__.copy()
+        del state["_lock"]
+        del state["_buckets"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        for animation in self._animations:
+            self._add_to_buckets(animation)
+
+    def _bucket(self, bucket_index):
+        bucket = self._buckets.get(bucket_index)
+        if bucket is not None or not self._spill_directory:
+            return bucket or []
 
-    def items(self):
-        return self._data.items()
+        with self._lock:
+            bucket = self._loaded_buckets.get(bucket_index)
+            if bucket is None:
+                path = self._bucket_path(bucket_index)
+                bucket = []
+                if os.path.exists(path):
+                    with open(path, "rb") as f:
+                        bucket = pickle.load(f)
+                self._loaded_buckets[bucket_index] = bucket
+                # Frames are drawn roughly in order, so only a couple of buckets need to stay loaded
+                while len(self._loaded_buckets) > 2:
+                    self._loaded_buckets.popitem(last=False)
+            else:
+                self._loaded_buckets.move_to_end(bucket_index)
+        return bucket
 
-    def _ensure_layer_length(self, length):
-        for layer_id in self._data:
-            self._data[layer_id].extend([None] * (length - len(self._data[layer_id])))
+    def frame(self, frame_index):
+        """Return the [draw_function, {kwargs}] pairs of one frame, in layer order"""
+        playing = {}
+        for animation in self._bucket(frame_index // FRAMES_PER_BUCKET):
+            layer_id, start_frame, end_frame, _, _ = animation
+            if start_frame <= frame_index < end_frame:
+                playing[layer_id] = animation
 
-    def add_frames_to_layer(self, layer_id, frame_index, images):
-        # Find the new length, which is the longer of the current max length or the new frame_index + number of images
-        new_length = max(
-            frame_index + len(images),
-            max((len(frames) for frames in self._data.values()), default=0),
-        )
+        images = []
+        for layer_id in sorted(playing):
+            _, start_frame, _, draw_function, kwargs = playing[layer_id]
+            images.append(
+                [draw_function, {**kwargs, "frame_number": frame_index - start_frame}]
+            )
+        return images
 
-        # Extend all layers to the new length
-        self._ensure_layer_length(new_length)
+    def _bucket_path(self, bucket_index):
+        return os.path.join(self._spill_directory, f"frames_{bucket_index:06d}.pkl")
 
-        # Add new layer if it doesn't exist
-        if layer_id not in self._data:
-            self._data[layer_id] = [None] * new_length
+    def spill_as_planned(self, directory, should_spill):
+        """
+        Once `should_spill(self)` is true, write the buckets that planning is done with to disk,
+        one file per bucket of frames, and release them from memory. See `planned_until`.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self._spill_directory = directory
+        self._should_spill = should_spill
 
-        # Set images at the correct frame index
-        for i, image in enumerate(images):
-            self._data[layer_id][frame_index + i] = image
+    def planned_until(self, frame_index):
+        """Called by the planner once no animation starting before `frame_index` will be added"""
+        if not self._should_spill or not self._should_spill(self):
+            return
+        finished = [b for b in self._buckets if b < frame_index // FRAMES_PER_BUCKET]
+        if not finished:
+            return
+        for bucket_index in finished:
+            with open(self._bucket_path(bucket_index), "wb") as f:
+                pickle.dump(
+                    self._buckets.pop(bucket_index), f, protocol=pickle.HIGHEST_PROTOCOL
+                )
+        spilled_until = (max(finished) + 1) * FRAMES_PER_BUCKET
+        # Animations still playing in a bucket held in memory are kept
+        self._animations = [a for a in self._animations if a[2] > spilled_until]
 
     def __str__(self):
-        return str(self._data)
+        return str(self._animations)
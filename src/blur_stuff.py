@@ -0,0 +1,63 @@
+import math
+
+from PIL import Image, ImageFilter
+
+# Blur radii are rounded to this resolution so that blurred sprites and masks can be reused
+BLUR_RADIUS_RESOLUTION = 0.5
+
+# Above this radius, images are blurred at a lower resolution and scaled back up.
+# A wide blur has no fine detail left, so the difference is at most a few levels out of 255
+DOWNSCALE_BLUR_RADIUS = 8
+
+
+def quantize_blur_radius(blur_radius, resolution=None):
+    resolution = resolution or BLUR_RADIUS_RESOLUTION
+    return round(blur_radius / resolution) * resolution
+
+
+def blur_padding(blur_radius):
+    """How far a blur spreads, images padded by this much are not clipped"""
+    return math.ceil(blur_radius * 3) + 2
+
+
+def gaussian_blur(image, blur_radius):
+    """
+    A faster ImageFilter.GaussianBlur, for L and RGBA images on a transparent (zero) background.
+    Only the area around the non-transparent pixels is blurred, and wide blurs are done on a
+    downscaled copy, since PIL's blur gets slower with the number of pixels, not the radius.
+    """
+    if not blur_radius:
+        return image
+
+    bounds = image.getbbox()
+    if bounds is None:
+        return image
+
+    padding = blur_padding(blur_radius)
+    left, top, right, bottom = bounds
+    crop_box = (
+        max(0, left - padding),
+        max(0, top - padding),
+        min(image.width, right + padding),
+        min(image.height, bottom + padding),
+    )
+    cropped = image.crop(crop_box)
+
+    factor = max(1, math.ceil(blur_radius / DOWNSCALE_BLUR_RADIUS))
+    if factor > 1:
+        small = cropped.reduce(factor)
+        small = small.filter(ImageFilter.GaussianBlur(blur_radius / factor))
+        # Each small pixel covers `factor` pixels, partial ones at the edges included
+        blurred = small.resize(
+            cropped.size,
+            Image.BILINEAR,
+            box=(0, 0, cropped.width / factor, cropped.height / factor),
+        )
+    else:
+        blurred = cropped.filter(ImageFilter.GaussianBlur(blur_radius))
+
+    if crop_box == (0, 0, image.width, image.height):
+        return blurred
+    result = Image.new(image.mode, image.size, 0)
+    result.paste(blurred, crop_box[:2])
+    return result
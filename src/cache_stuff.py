@@ -1,4 +1,5 @@
 import shutil
+from contextlib import contextmanager
 from uuid import uuid4
 import os
 import hashlib
@@ -7,21 +8,33 @@ import hashlib
 _cache_dir_created = False
 _cache_dir = None
 
-_music_cache_base_dir = ".cache/.music_cache"
-os.makedirs(_music_cache_base_dir, exist_ok=True)
+# Each render gets its own scratch directory in here
+_cache_base_dir = os.environ.get("MUSIC_GRAPHS_CACHE", ".cache")
+
+# Can point at a shared volume, the files written there are safe to share between hosts
+_music_cache_base_dir = os.environ.get(
+    "MUSIC_GRAPHS_MUSIC_CACHE", ".cache/.music_cache"
+)
+
+# Graph layouts and base images, shared by every process rendering on this host
+_layout_cache_dir = os.environ.get("MUSIC_GRAPHS_LAYOUT_CACHE", ".cache/.layout_cache")
 
 
 def get_cache_dir():
     global _cache_dir_created, _cache_dir
     if not _cache_dir_created:
-        _cache_dir = f".cache/{uuid4()}"
+        _cache_dir = os.path.join(_cache_base_dir, str(uuid4()))
         os.makedirs(_cache_dir, exist_ok=True)
         _cache_dir_created = True
     return _cache_dir
 
 
 def cleanup_cache_dir(cache_dir):
-    shutil.rmtree(cache_dir)
+    global _cache_dir_created
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    if cache_dir == _cache_dir:
+        # The next render gets a fresh directory
+        _cache_dir_created = False
 
 
 def get_music_cache_dir(midi_file_path):
@@ -33,3 +46,65 @@ def get_music_cache_dir(midi_file_path):
     os.makedirs(cache_dir, exist_ok=True)
 
     return cache_dir
+
+
+def file_signature(path):
+    """Changes when the file at `path` is edited or replaced"""
+    if not path or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+def get_layout_cache_dir():
+    os.makedirs(_layout_cache_dir, exist_ok=True)
+    return _layout_cache_dir
+
+
+def trim_cache_dir(directory, max_bytes, keep=()):
+    """
+    Remove the least recently used entries of `directory` until it holds at most `max_bytes`.
+    An entry is every file named the same up to its first dot, it was last used when its newest file was modified.
+    Entries in `keep` and files that are still being written are left alone.
+    """
+    entries = {}
+    for name in os.listdir(directory):
+        if name.endswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            # Removed by another process sharing the cache
+            continue
+        key = name.split(".", 1)[0]
+        used, size, names = entries.get(key, (0, 0, []))
+        entries[key] = (max(used, stat.st_mtime), size + stat.st_size, names + [name])
+
+    total_bytes = sum(size for _, size, _ in entries.values())
+    for key, (_, size, names) in sorted(entries.items(), key=lambda entry: entry[1][0]):
+        if total_bytes <= max_bytes:
+            break
+        if key in keep:
+            continue
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+        total_bytes -= size
+
+
+@contextmanager
+def atomic_write_path(path, suffix=".tmp"):
+    """
+    Yield a temporary path next to `path`, and move it into place once it has been written.
+    Readers never see a partially written file, even on a shared cache volume.
+    `suffix` is for tools that pick the file format from the extension.
+    """
+    temp_path = f"{path}.{uuid4()}{suffix}"
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
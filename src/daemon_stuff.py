@@ -0,0 +1,466 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+from src.encoder_stuff import check_encoder
+from src.generate_music_graph import Renderer, worker_process_context
+from src.memory_stuff import parse_memory_size
+from src.options_stuff import (
+    DEFAULT_CODEC,
+    DEFAULT_CRF,
+    DEFAULT_PRESET,
+    ENCODERS,
+    SOUND_FONT_FILE,
+    STREAM_ENCODERS,
+    parse_resolution,
+)
+from src.telemetry_stuff import Telemetry
+from src.theme_stuff import DARK_THEME_FILE, LIGHT_THEME_FILE
+
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 2
+
+# Finished jobs are kept around this long for /jobs, so the service doesn't grow forever
+FINISHED_JOB_SECONDS = 60 * 60
+
+# The renderer of a worker process, kept warm between jobs
+_renderer = None
+_progress_queue = None
+_job_id = None
+
+
+def _send_telemetry(record):
+    _progress_queue.put(("telemetry", _job_id, record))
+
+
+def _init_worker(progress_queue, num_threads, telemetry_interval):
+    global _renderer, _progress_queue
+    _progress_queue = progress_queue
+    telemetry = None
+    if telemetry_interval is not None:
+        telemetry = Telemetry(callback=_send_telemetry, interval=telemetry_interval)
+    _renderer = Renderer(num_workers=num_threads, telemetry=telemetry)
+
+
+def _run_job(job_id, midi, default_theme, theme, output_filename, options):
+    """Render one job in a worker process, progress and telemetry are sent back through the progress queue"""
+    global _job_id
+
+    def on_progress(stage, done, total):
+        _progress_queue.put(("progress", job_id, (stage, done, total)))
+
+    _job_id = job_id
+    _progress_queue.put(("started", job_id, os.getpid()))
+    _renderer.on_progress = on_progress
+    try:
+        return _renderer.render(midi, default_theme, theme, output_filename, **options)
+    finally:
+        _renderer.on_progress = None
+
+
+def _int_option(request, name, default):
+    value = request.get(name, default)
+    # JSON has no separate integer type, but true and false shouldn't pass as 1 and 0
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    try:
+        return int(value)
+    except (OverflowError, ValueError):
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+
+
+def _string_option(request, name, default=None):
+    value = request.get(name, default)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f"{name} must be a string, got {value!r}")
+    return value
+
+
+class Job:
+    def __init__(self, job_id, priority, midi, theme, output_filename):
+        self.id = job_id
+        self.priority = priority
+        self.midi = midi
+        self.theme = theme
+        self.output_filename = output_filename
+        self.status = "queued"
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.worker_pid = None
+        self.output_path = None
+        self.output_paths = {}
+        self.frames_written = 0
+        self.timings = {}
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "priority": self.priority,
+            "midi": self.midi,
+            "theme": self.theme,
+            "status": self.status,
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "worker_pid": self.worker_pid,
+            "output_path": self.output_path,
+            "output_paths": self.output_paths,
+            "frames_written": self.frames_written,
+            "timings": self.timings,
+            "error": self.error,
+        }
+
+
+class RenderService:
+    """
+    Queues render jobs and runs them on a pool of worker processes, highest priority first.
+    Each worker keeps a Renderer warm between jobs, and they all share the on-disk note, layout and music caches.
+    With `telemetry`, the workers' render events are sent to it tagged with their "job",
+    along with an event for every job that is queued, started or finished, with the queue depth.
+    """
+
+    def __init__(self, num_workers=DEFAULT_WORKERS, telemetry=None):
+        self.num_workers = num_workers
+        self.telemetry = telemetry or Telemetry()
+        self.started_at = time.time()
+        self._jobs = {}
+        self._queue = []
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # The HTTP and dispatch threads are running by the time workers start
+        self._mp_context = worker_process_context()
+        self._progress_queue = self._mp_context.Queue()
+        self._executor = self._create_executor()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+        threading.Thread(target=self._listen_for_progress, daemon=True).start()
+
+    def _create_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=self._mp_context,
+            initializer=_init_worker,
+            initargs=(
+                self._progress_queue,
+                max(1, (os.cpu_count() or 1) // self.num_workers),
+                self.telemetry.interval if self.telemetry.enabled else None,
+            ),
+        )
+
+    def _replace_executor(self, broken):
+        """Start a fresh pool once a worker has died, the broken pool can't run anything else"""
+        with self._condition:
+            if self._closed or self._executor is not broken:
+                # Shutting down, or already replaced for another job
+                return
+            self._executor = self._create_executor()
+        broken.shutdown(wait=False)
+
+    def submit(self, request):
+        """Queue a job from a request like {"midi": path, "theme": path, "dark": false, "priority": 0, ...}"""
+        midi = _string_option(request, "midi")
+        if not midi or not os.path.isfile(midi):
+            raise ValueError(f"MIDI file not found: {midi}")
+
+        default_theme = DARK_THEME_FILE if request.get("dark") else LIGHT_THEME_FILE
+        theme = _string_option(request, "theme") or default_theme
+        if not os.path.isfile(theme):
+            raise ValueError(f"Theme file not found: {theme}")
+
+        encoder = _string_option(request, "encoder", "ffmpeg")
+        if encoder not in ENCODERS or encoder in STREAM_ENCODERS:
+            raise ValueError(f"Encoder {encoder} can't be used by the render service")
+        check_encoder(encoder)
+
+        max_memory = request.get("max_memory")
+        if max_memory is not None:
+            max_memory = parse_memory_size(str(max_memory))
+        frame_cache_size = request.get("frame_cache_size")
+        if frame_cache_size is not None:
+            frame_cache_size = parse_memory_size(str(frame_cache_size))
+
+        resolutions = request.get("resolutions") or []
+        if not isinstance(resolutions, list):
+            raise ValueError(f"resolutions must be a list, got {resolutions!r}")
+        resolutions = [parse_resolution(str(resolution)) for resolution in resolutions]
+
+        output_filename = _string_option(request, "output_filename")
+        if not output_filename:
+            output_filename, _ = os.path.splitext(os.path.basename(midi))
+
+        options = {
+            "soundfont_file": _string_option(
+                request, "soundfont_file", SOUND_FONT_FILE
+            ),
+            "encoder": encoder,
+            "codec": _string_option(request, "codec", DEFAULT_CODEC),
+            "preset": _string_option(request, "preset", DEFAULT_PRESET),
+            "crf": _int_option(request, "crf", DEFAULT_CRF),
+            "encoder_threads": _int_option(request, "encoder_threads", 0),
+            "max_memory": max_memory,
+            "frame_cache_size": frame_cache_size,
+            "resolutions": resolutions,
+        }
+        priority = _int_option(request, "priority", 0)
+
+        with self._condition:
+            if self._closed:
+                raise ValueError("The render service is shutting down")
+            job = Job(str(next(self._ids)), priority, midi, theme, output_filename)
+            self._jobs[job.id] = job
+            # Higher priorities first, then first come first served
+            heapq.heappush(
+                self._queue,
+                (-priority, int(job.id), job, (default_theme, options)),
+            )
+            self._emit_job_event("job_queued", job)
+            self._condition.notify_all()
+        return job
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not self._closed and (
+                    not self._queue or self._running >= self.num_workers
+                ):
+                    self._condition.wait()
+                if self._closed:
+                    return
+                _, _, job, (default_theme, options) = heapq.heappop(self._queue)
+                self._running += 1
+                job.status = "running"
+                job.started_at = time.time()
+                self._emit_job_event("job_started", job)
+                executor = self._executor
+
+            try:
+                future = executor.submit(
+                    _run_job,
+                    job.id,
+                    job.midi,
+                    default_theme,
+                    job.theme,
+                    job.output_filename,
+                    options,
+                )
+            except BrokenProcessPool as e:
+                # A worker died since the last job finished, e.g. killed for running out of memory
+                self._finish_job(job, error=e)
+                self._replace_executor(executor)
+                continue
+            except RuntimeError as e:
+                # The pool was shut down while this job was being started
+                self._finish_job(job, error=e)
+                return
+            future.add_done_callback(
+                lambda future, job=job, executor=executor: self._job_finished(
+                    job, future, executor
+                )
+            )
+
+    def _job_finished(self, job, future, executor):
+        if future.cancelled():
+            # The service is shutting down, result() would raise CancelledError
+            self._finish_job(job, cancelled=True)
+            return
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            self._finish_job(job, error=e)
+            self._replace_executor(executor)
+        except Exception as e:
+            self._finish_job(job, error=e)
+        else:
+            self._finish_job(job, result=result)
+
+    def _finish_job(self, job, result=None, error=None, cancelled=False):
+        with self._condition:
+            self._running -= 1
+            job.finished_at = time.time()
+            if cancelled:
+                job.status = "cancelled"
+            elif error is not None:
+                job.status = "failed"
+                job.error = str(error) or type(error).__name__
+            else:
+                job.status = "done"
+                job.output_path = result.output_path
+                job.output_paths = result.output_paths
+                job.frames_written = result.frames_written
+                job.timings = result.timings
+            self._emit_job_event("job_finished", job, status=job.status)
+            self._forget_old_jobs()
+            self._condition.notify_all()
+
+    def _emit_job_event(self, event, job, **fields):
+        self.telemetry.emit(
+            event,
+            job=job.id,
+            priority=job.priority,
+            queued=len(self._queue),
+            running=self._running,
+            **fields,
+        )
+
+    def _forget_old_jobs(self):
+        cutoff = time.time() - FINISHED_JOB_SECONDS
+        for job_id in [
+            job.id
+            for job in self._jobs.values()
+            if job.finished_at and job.finished_at < cutoff
+        ]:
+            del self._jobs[job_id]
+
+    def _listen_for_progress(self):
+        while True:
+            try:
+                kind, job_id, message = self._progress_queue.get()
+            except (EOFError, OSError, ValueError):
+                # The queue was closed, the service is shutting down
+                return
+            if kind == "telemetry":
+                # Keeps the time the worker sent it at
+                self.telemetry.emit(message.pop("event"), job=job_id, **message)
+                continue
+            if kind == "started":
+                with self._condition:
+                    job = self._jobs.get(job_id)
+                    if job:
+                        job.worker_pid = message
+                continue
+            stage, done, total = message
+            with self._condition:
+                job = self._jobs.get(job_id)
+                if job and job.status == "running":
+                    job.stage = stage
+                    job.done = done
+                    job.total = total
+
+    def job(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return job and job.to_dict()
+
+    def jobs(self):
+        with self._condition:
+            return [job.to_dict() for job in self._jobs.values()]
+
+    def stats(self):
+        with self._condition:
+            uptime = time.time() - self.started_at
+            finished = [job for job in self._jobs.values() if job.finished_at]
+            done = [job for job in finished if job.status == "done"]
+            frames = sum(job.frames_written for job in done)
+            render_seconds = sum(job.finished_at - job.started_at for job in done)
+            return {
+                "workers": self.num_workers,
+                "queued": len(self._queue),
+                "running": self._running,
+                "done": len(done),
+                "failed": sum(job.status == "failed" for job in finished),
+                "uptime": uptime,
+                "jobs_per_minute": len(done) / uptime * 60,
+                "frames_per_second": frames / render_seconds if render_seconds else 0,
+            }
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._executor.shutdown(cancel_futures=True)
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP:
+    POST /jobs to queue a job, GET /jobs/<id> for its status and stage timings,
+    GET /jobs for every job and GET /stats for queue depth and throughput.
+    """
+
+    service = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return self.client_address[0]
+        return "unix"
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        if path == "/stats":
+            self._send_json(200, self.service.stats())
+        elif path == "/jobs":
+            self._send_json(200, self.service.jobs())
+        elif path.startswith("/jobs/"):
+            job = self.service.job(path[len("/jobs/") :])
+            if job is None:
+                self._send_json(404, {"error": "No such job"})
+            else:
+                self._send_json(200, job)
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Expected a JSON object")
+            job = self.service.submit(request)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        self._send_json(202, job.to_dict())
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def create_server(service, port=DEFAULT_PORT, socket_path=None):
+    """Serve the render service on a localhost port, or on a Unix socket"""
+    handler = type("Handler", (RenderRequestHandler,), {"service": service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            # Left behind by a daemon that didn't shut down cleanly
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
@@ -0,0 +1,291 @@
+import os
+import shutil
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from src.options_stuff import (
+    DEFAULT_CODEC,
+    DEFAULT_CRF,
+    DEFAULT_PRESET,
+    STREAM_ENCODERS,
+)
+
+
+FFMPEG_NOT_FOUND = "ffmpeg was not found on the PATH, see the README for how to install it"
+
+
+def get_ffmpeg_exe():
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise RuntimeError(FFMPEG_NOT_FOUND)
+    return ffmpeg
+
+
+def check_encoder(encoder):
+    """Raise a ValueError if `encoder` can't be used with the programs and libraries installed"""
+    if encoder == "ffmpeg" and not shutil.which("ffmpeg"):
+        raise ValueError(FFMPEG_NOT_FOUND)
+    if encoder in ["png", "qoi"]:
+        Image.init()
+        if encoder.upper() not in Image.SAVE:
+            raise ValueError(
+                f"This version of Pillow can not write {encoder} images, upgrade it to use the {encoder} encoder"
+            )
+
+
+class Encoder(ABC):
+    """
+    Base class for the places frames can be written to.
+    Frames are the compositor's RGBA uint8 buffers, and must be consumed before `write_frame` returns.
+    Time spent inside the encoder is tracked separately, so it can be reported apart from rendering.
+    """
+
+    def __init__(self, size, frame_rate):
+        self.size = size
+        self.frame_rate = frame_rate
+        self.output_path = None
+        self.frames_written = 0
+        self.encode_seconds = 0.0
+        self._closed = False
+
+    @property
+    def frames_per_second(self):
+        if not self.encode_seconds:
+            return 0.0
+        return self.frames_written / self.encode_seconds
+
+    def write_frame(self, frame):
+        start = time.perf_counter()
+        self._write(frame)
+        self.encode_seconds += time.perf_counter() - start
+        self.frames_written += 1
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        start = time.perf_counter()
+        self._close()
+        self.encode_seconds += time.perf_counter() - start
+
+    @abstractmethod
+    def _write(self, frame):
+        pass
+
+    def _close(self):
+        pass
+
+
+class FFmpegPipeEncoder(Encoder):
+    """Pipes raw RGBA frames into an ffmpeg subprocess"""
+
+    def __init__(
+        self,
+        output_path,
+        size,
+        frame_rate,
+        codec=DEFAULT_CODEC,
+        preset=DEFAULT_PRESET,
+        crf=DEFAULT_CRF,
+        threads=0,
+    ):
+        super().__init__(size, frame_rate)
+        self.output_path = output_path
+        width, height = size
+        command = [
+            get_ffmpeg_exe(),
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgba",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(frame_rate),
+            "-i",
+            "-",
+            "-an",
+            "-c:v",
+            codec,
+            "-pix_fmt",
+            "yuv420p",
+        ]
+        if preset:
+            command += ["-preset", preset]
+        if crf is not None:
+            command += ["-crf", str(crf)]
+        if threads:
+            command += ["-threads", str(threads)]
+        command.append(output_path)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def _write(self, frame):
+        self._process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def _close(self):
+        self._process.stdin.close()
+        if self._process.wait():
+            raise RuntimeError(f"ffmpeg exited with code {self._process.returncode}")
+
+
+class ScaledEncoder(Encoder):
+    """Scales frames down to another encoder's size before it encodes them"""
+
+    def __init__(self, encoder, source_size):
+        super().__init__(encoder.size, encoder.frame_rate)
+        self.encoder = encoder
+        self.source_size = source_size
+        self.output_path = encoder.output_path
+
+    def _write(self, frame):
+        # Frames are premultiplied, which is what PIL converts RGBA to for resampling anyway
+        image = Image.frombuffer(
+            "RGBa", self.source_size, np.ascontiguousarray(frame), "raw", "RGBa", 0, 1
+        )
+        scaled = image.resize(self.size, Image.BILINEAR, reducing_gap=2.0)
+        self.encoder.write_frame(np.asarray(scaled))
+
+    def _close(self):
+        self.encoder.close()
+
+
+class MultiEncoder(Encoder):
+    """
+    Writes every frame to several encoders, e.g. the same render at several resolutions.
+    The encoders run side by side, and `write_frame` returns once all of them are done with the frame.
+    """
+
+    def __init__(self, encoders):
+        super().__init__(encoders[0].size, encoders[0].frame_rate)
+        self.encoders = encoders
+        self.output_path = [encoder.output_path for encoder in encoders]
+        self._executor = ThreadPoolExecutor(max_workers=len(encoders))
+
+    def _write(self, frame):
+        futures = [
+            self._executor.submit(encoder.write_frame, frame)
+            for encoder in self.encoders
+        ]
+        for future in futures:
+            future.result()
+
+    def _close(self):
+        errors = []
+        for encoder in self.encoders:
+            try:
+                encoder.close()
+            except Exception as e:
+                errors.append(e)
+        self._executor.shutdown()
+        if errors:
+            raise errors[0]
+
+
+def rgb_to_yuv444(rgb):
+    """Convert RGB to BT.601 limited range Y, U and V planes"""
+    rgb = rgb.astype(np.float32)
+    y = 16 + rgb @ np.array([0.2568, 0.5041, 0.0979], dtype=np.float32)
+    u = 128 + rgb @ np.array([-0.1482, -0.2910, 0.4392], dtype=np.float32)
+    v = 128 + rgb @ np.array([0.4392, -0.3678, -0.0714], dtype=np.float32)
+    return np.stack([y, u, v]).round().astype(np.uint8)
+
+
+class RawStreamEncoder(Encoder):
+    """
+    Writes frames to a binary stream (stdout by default), so they can be piped into other tools.
+    `pixel_format` is "y4m" (YUV 4:4:4), "rgb" or "rgba".
+    """
+
+    def __init__(self, size, frame_rate, pixel_format="y4m", stream=None):
+        super().__init__(size, frame_rate)
+        self.pixel_format = pixel_format
+        self._stream = stream or sys.stdout.buffer
+        width, height = size
+        if pixel_format == "y4m":
+            self._stream.write(
+                f"YUV4MPEG2 W{width} H{height} F{frame_rate}:1 Ip A1:1 C444\n".encode()
+            )
+        elif pixel_format == "rgb":
+            self._rgb = np.empty((height, width, 3), dtype=np.uint8)
+
+    def _write(self, frame):
+        try:
+            self._write_frame(frame)
+        except BrokenPipeError:
+            if self._stream is sys.stdout.buffer:
+                # Python flushes stdout again on exit, which would fail too
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            raise
+
+    def _write_frame(self, frame):
+        if self.pixel_format == "y4m":
+            self._stream.write(b"FRAME\n")
+            self._stream.write(rgb_to_yuv444(frame[..., :3]).data)
+        elif self.pixel_format == "rgb":
+            np.copyto(self._rgb, frame[..., :3])
+            self._stream.write(self._rgb.data)
+        else:
+            self._stream.write(np.ascontiguousarray(frame).data)
+
+    def _close(self):
+        try:
+            self._stream.flush()
+        except BrokenPipeError:
+            pass
+
+
+class ImageSequenceEncoder(Encoder):
+    """Writes every frame as a numbered PNG or QOI image, for use in video editors"""
+
+    def __init__(self, output_path, size, frame_rate, image_format="png"):
+        super().__init__(size, frame_rate)
+        check_encoder(image_format)
+        self.output_path = output_path
+        self.image_format = image_format
+        os.makedirs(output_path, exist_ok=True)
+
+    def _write(self, frame):
+        image = Image.fromarray(np.ascontiguousarray(frame[..., :3]))
+        path = os.path.join(
+            self.output_path, f"frame_{self.frames_written:06d}.{self.image_format}"
+        )
+        if self.image_format == "png":
+            image.save(path, compress_level=1)
+        else:
+            image.save(path)
+
+
+def create_encoder(
+    encoder,
+    size,
+    frame_rate,
+    output_path=None,
+    codec=DEFAULT_CODEC,
+    preset=DEFAULT_PRESET,
+    crf=DEFAULT_CRF,
+    threads=0,
+):
+    if encoder == "ffmpeg":
+        return FFmpegPipeEncoder(
+            output_path,
+            size,
+            frame_rate,
+            codec=codec,
+            preset=preset,
+            crf=crf,
+            threads=threads,
+        )
+    if encoder in STREAM_ENCODERS:
+        return RawStreamEncoder(size, frame_rate, pixel_format=encoder)
+    if encoder in ["png", "qoi"]:
+        return ImageSequenceEncoder(output_path, size, frame_rate, image_format=encoder)
+    raise ValueError(f"Unknown encoder: {encoder}")
@@ -0,0 +1,151 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from src.cache_stuff import atomic_write_path
+from src.frame_stuff import FrameCompositor
+from src.graph_stuff import ELLIPSE_MASK_CACHE_BYTES
+from src.layer_group_stuff import LAYER_GROUP_CACHE_BYTES
+from src.memory_stuff import BYTES_PER_FRAME_IN_FLIGHT_FACTOR, MemoryBudget, get_rss
+
+# Where `--calibrate` keeps the costs it measured on this machine
+_cost_model_path = os.environ.get("MUSIC_GRAPHS_COST_MODEL", ".cache/cost_model.json")
+
+# Seconds per call of each draw function, and per frame for resetting and blending it,
+# measured on a single core. Run `--calibrate` for the costs of the machine doing the render
+DEFAULT_COST_MODEL = {
+    "frame": 0.01,
+    "draws": {
+        "animate_ellipsis_blur": 0.0012,
+        "draw_fading_bezier_curve": 0.0011,
+        "animate_bezier_point": 0.0005,
+    },
+}
+
+# Calibration draws a few runs of consecutive frames spread over the song,
+# consecutive so the sprite and mask caches are as warm as in a real render
+CALIBRATION_RUNS = 6
+CALIBRATION_RUN_LENGTH = 10
+
+
+def load_cost_model():
+    """The calibrated cost model if there is one, else the default, and whether it was calibrated"""
+    try:
+        with open(_cost_model_path) as f:
+            calibrated = json.load(f)
+    except (OSError, ValueError):
+        return DEFAULT_COST_MODEL, False
+    model = {
+        "frame": calibrated.get("frame", DEFAULT_COST_MODEL["frame"]),
+        "draws": {**DEFAULT_COST_MODEL["draws"], **calibrated.get("draws", {})},
+    }
+    return model, True
+
+
+def save_cost_model(model):
+    os.makedirs(os.path.dirname(_cost_model_path) or ".", exist_ok=True)
+    with atomic_write_path(_cost_model_path) as temp_path:
+        with open(temp_path, "w") as f:
+            json.dump(model, f, indent=2)
+
+
+def plan_stats(frames, num_frames):
+    """Layers per frame and number of draws by draw function, walking the plan without drawing"""
+    layers = np.zeros(num_frames, dtype=np.int64)
+    draws = {}
+    for frame_index in range(num_frames):
+        draw_list = frames.frame(frame_index)
+        layers[frame_index] = len(draw_list)
+        for draw_function, _ in draw_list:
+            name = draw_function.__name__
+            draws[name] = draws.get(name, 0) + 1
+
+    if not num_frames:
+        layers = np.zeros(1, dtype=np.int64)
+    return {
+        "frames": num_frames,
+        "animations": frames.num_animations,
+        "layers_per_frame": {
+            "min": int(layers.min()),
+            "mean": round(float(layers.mean()), 2),
+            "p99": int(np.percentile(layers, 99)),
+            "max": int(layers.max()),
+            "busiest_frame": int(layers.argmax()),
+        },
+        "draws": dict(sorted(draws.items())),
+    }
+
+
+def calibrate(frames, num_frames, theme, offsets, base_frame):
+    """Draw a sample of the song's frames, and measure the cost of each draw function and of a frame"""
+    run_starts = np.linspace(
+        0, max(0, num_frames - CALIBRATION_RUN_LENGTH), CALIBRATION_RUNS, dtype=int
+    )
+    sample = sorted(
+        {
+            frame_index
+            for start in run_starts
+            for frame_index in range(start, start + CALIBRATION_RUN_LENGTH)
+            if frame_index < num_frames
+        }
+    )
+
+    compositor = FrameCompositor(base_frame)
+    draw_seconds = {}
+    draw_calls = {}
+    frame_seconds = 0.0
+    for frame_index in sample:
+        frame_start = time.perf_counter()
+        compositor.reset()
+        for draw_function, kwargs in frames.frame(frame_index):
+            name = draw_function.__name__
+            start = time.perf_counter()
+            patch = draw_function(theme=theme, offsets=offsets, **kwargs)
+            draw_seconds[name] = draw_seconds.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+            draw_calls[name] = draw_calls.get(name, 0) + 1
+            if patch:
+                compositor.blend(*patch)
+        frame_seconds += time.perf_counter() - frame_start
+
+    total_draw_seconds = sum(draw_seconds.values())
+    model, _ = load_cost_model()
+    return {
+        "frame": (
+            (frame_seconds - total_draw_seconds) / len(sample)
+            if sample
+            else model["frame"]
+        ),
+        "draws": {
+            **model["draws"],
+            **{name: draw_seconds[name] / draw_calls[name] for name in draw_calls},
+        },
+    }
+
+
+def estimate_seconds(stats, model, num_workers):
+    """Seconds to draw the planned frames, assuming the drawing spreads evenly over the workers"""
+    seconds = stats["frames"] * model["frame"]
+    for name, count in stats["draws"].items():
+        seconds += count * model["draws"].get(name, max(model["draws"].values()))
+    return seconds / max(1, min(num_workers, os.cpu_count() or 1))
+
+
+def estimate_peak_memory(theme, frames, num_workers, max_memory=None):
+    """
+    Bytes the render would need at its peak: what is in memory now that the song is planned,
+    plus the frames in flight, the pulse mask cache and the layer group cache.
+    The plan counts as it is held after planning, so `frames` must have been planned with the same budget.
+    """
+    budget = MemoryBudget(max_memory)
+    peak = get_rss()
+    frame_bytes = theme.width * theme.height * 4
+    max_in_flight = budget.max_frames_in_flight(frame_bytes, default=num_workers * 2)
+    peak += max_in_flight * frame_bytes * BYTES_PER_FRAME_IN_FLIGHT_FACTOR
+    peak += budget.ellipse_mask_bytes(ELLIPSE_MASK_CACHE_BYTES)
+    if theme.layer_groups:
+        peak += budget.layer_group_bytes(LAYER_GROUP_CACHE_BYTES)
+    return peak
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from src.cache_stuff import atomic_write_path
+from src.graph_stuff import layer_state
+
+# Can point at a shared volume, frames are stored under the hash of everything that went into drawing them
+_frame_cache_dir = os.environ.get("MUSIC_GRAPHS_FRAME_CACHE", ".cache/.frame_cache")
+
+# Bump this whenever a draw function changes what it draws
+FRAME_CACHE_VERSION = 2
+
+# x, y, width, height of the part of the frame that differs from the base frame
+_HEADER = struct.Struct("<4i")
+
+
+def get_frame_cache_dir():
+    os.makedirs(_frame_cache_dir, exist_ok=True)
+    return _frame_cache_dir
+
+
+class FrameCache:
+    """
+    Content-addressed cache of drawn frames, shared between renders.
+    A frame is keyed by the hash of its draw list: the draw functions, their arguments and the theme
+    styles of their tracks, on top of the base frame. When a theme changes only some tracks,
+    the frames that don't show those tracks are loaded instead of drawn.
+    Only the part of a frame that was drawn over the base frame is stored, compressed.
+    The least recently used frames are removed once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, theme, base_frame, offsets, max_bytes, directory=None):
+        self.theme = theme
+        self.max_bytes = max_bytes
+        self.directory = directory or get_frame_cache_dir()
+        self.hits = 0
+        self.misses = 0
+        self._track_styles = {}
+        self._lock = threading.Lock()
+
+        base_hash = hashlib.sha256(base_frame.tobytes()).hexdigest()
+        self._prefix = repr(
+            (
+                FRAME_CACHE_VERSION,
+                base_hash,
+                base_frame.shape,
+                tuple(offsets),
+                theme.blur_radius_resolution,
+                theme.layer_groups,
+            )
+        )
+
+        # Oldest first, by the last time they were used
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".frame"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, name[: -len(".frame")], stat.st_size))
+        entries.sort()
+        self._sizes = OrderedDict((key, size) for _, key, size in entries)
+        self._total_bytes = sum(self._sizes.values())
+        self._trim()
+
+    def _track_style(self, track):
+        style = self._track_styles.get(track)
+        if style is None:
+            style = self._track_styles[track] = repr(self.theme.track_style(track))
+        return style
+
+    def key(self, draw_list):
+        """Hash a frame's [draw_function, {kwargs}] pairs"""
+        digest = hashlib.sha256(self._prefix.encode())
+        for draw_function, kwargs in draw_list:
+            digest.update(repr(layer_state(draw_function, kwargs)).encode())
+            if "track" in kwargs:
+                digest.update(self._track_style(kwargs["track"]).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.frame")
+
+    def load(self, key, compositor):
+        """Draw a cached frame into the (reset) compositor, returns False if it isn't cached"""
+        with self._lock:
+            if key not in self._sizes:
+                self.misses += 1
+                return False
+            self._sizes.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            # Removed by another render sharing the cache
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return False
+
+        x, y, width, height = _HEADER.unpack_from(data)
+        if width and height:
+            region = np.frombuffer(zlib.decompress(data[_HEADER.size :]), np.uint8)
+            compositor.frame[y : y + height, x : x + width] = region.reshape(
+                height, width, 4
+            )
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, compositor):
+        """Store the frame the compositor just drew"""
+        x, y, width, height = compositor.drawn_bounds or (0, 0, 0, 0)
+        data = _HEADER.pack(x, y, width, height)
+        if width and height:
+            region = compositor.frame[y : y + height, x : x + width]
+            data += zlib.compress(np.ascontiguousarray(region), 1)
+
+        path = self._path(key)
+        with atomic_write_path(path) as temp_path:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+
+        with self._lock:
+            self._forget(key)
+            self._sizes[key] = len(data)
+            self._total_bytes += len(data)
+            self._trim()
+
+    def _trim(self):
+        # The frame that was just stored is always kept
+        while self._total_bytes > self.max_bytes and len(self._sizes) > 1:
+            oldest = next(iter(self._sizes))
+            self._forget(oldest)
+            try:
+                os.remove(self._path(oldest))
+            except OSError:
+                pass
+
+    def _forget(self, key):
+        size = self._sizes.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
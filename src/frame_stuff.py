@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def premultiply(rgba):
+    """Return a premultiplied-alpha copy of a straight-alpha RGBA uint8 array"""
+    result = np.array(rgba, dtype=np.uint8)
+    alpha = result[..., 3:4].astype(np.uint16)
+    result[..., :3] = (result[..., :3] * alpha + 127) // 255
+    return result
+
+
+def scale_patch(patch, alpha):
+    """Fade a premultiplied patch by `alpha` (0 - 255)"""
+    if alpha >= 255:
+        return patch
+    return ((patch.astype(np.uint16) * max(alpha, 0) + 127) // 255).astype(np.uint8)
+
+
+def composite_patches(patches):
+    """Blend premultiplied (patch, (x, y)) pairs in order, into one patch that covers all of them"""
+    if len(patches) == 1:
+        return patches[0]
+    left = min(x for _, (x, _) in patches)
+    top = min(y for _, (_, y) in patches)
+    right = max(x + patch.shape[1] for patch, (x, _) in patches)
+    bottom = max(y + patch.shape[0] for patch, (_, y) in patches)
+
+    group = FrameCompositor(np.zeros((bottom - top, right - left, 4), dtype=np.uint8))
+    group.reset()
+    for patch, (x, y) in patches:
+        group.blend(patch, (x - left, y - top))
+    return group.frame, (left, top)
+
+
+class FrameCompositor:
+    """
+    Keeps the working frame as one preallocated RGBA uint8 buffer.
+    Draw functions produce small premultiplied patches, which are blended into the buffer in place,
+    so rendering a frame does not allocate any full size images.
+    The buffer itself is handed to the encoder, so it must be written before the next `reset`.
+    """
+
+    def __init__(self, base_frame):
+        self._base_frame = base_frame
+        self.frame = np.empty_like(base_frame)
+        # (x, y, width, height) of everything blended since the last reset
+        self.drawn_bounds = None
+
+    @property
+    def size(self):
+        height, width = self.frame.shape[:2]
+        return width, height
+
+    def reset(self):
+        np.copyto(self.frame, self._base_frame)
+        self.drawn_bounds = None
+
+    def _add_drawn_bounds(self, left, top, right, bottom):
+        if self.drawn_bounds:
+            x, y, width, height = self.drawn_bounds
+            left = min(left, x)
+            top = min(top, y)
+            right = max(right, x + width)
+            bottom = max(bottom, y + height)
+        self.drawn_bounds = (left, top, right - left, bottom - top)
+
+    def blend(self, patch, dest):
+        """Blend a premultiplied RGBA patch over the frame, with its top left corner at `dest`"""
+        x, y = dest
+        height, width = self.frame.shape[:2]
+        left = max(0, -x)
+        top = max(0, -y)
+        right = min(patch.shape[1], width - x)
+        bottom = min(patch.shape[0], height - y)
+        if left >= right or top >= bottom:
+            return
+
+        source = patch[top:bottom, left:right]
+        region = self.frame[y + top : y + bottom, x + left : x + right]
+
+        # out = source + region * (1 - source_alpha)
+        blended = region * (255 - source[..., 3:4].astype(np.uint16))
+        blended += 127
+        blended //= 255
+        blended += source
+        np.copyto(region, blended, casting="unsafe")
+        self._add_drawn_bounds(x + left, y + top, x + right, y + bottom)
@@ -1,16 +1,48 @@
+import hashlib
+import json
+import multiprocessing
 import os
+import time
 import click
-import psutil
-from graphviz import Graph
-from hurry.filesize import size
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from src.animation_stuff import AnimationFrames
+from src.options_stuff import (
+    DEFAULT_CODEC,
+    DEFAULT_CRF,
+    DEFAULT_PRESET,
+    STREAM_ENCODERS,
+    VIDEO_FILE_ENCODERS,
+    check_resolutions,
+)
 from src.cache_stuff import (
+    atomic_write_path,
     cleanup_cache_dir,
+    file_signature,
     get_cache_dir,
+    get_layout_cache_dir,
+    trim_cache_dir,
+)
+from src.estimate_stuff import (
+    calibrate,
+    estimate_peak_memory,
+    estimate_seconds,
+    load_cost_model,
+    plan_stats,
+    save_cost_model,
 )
+from src.frame_cache_stuff import FrameCache
+from src.layer_group_stuff import LAYER_GROUP_CACHE_BYTES, LayerGroups
+from src.frame_stuff import FrameCompositor, premultiply
+from src.memory_stuff import MemoryBudget
+from src.telemetry_stuff import Telemetry, hit_rate
 from src.graph_stuff import (
+    ELLIPSE_MASK_CACHE_BYTES,
+    ELLIPSE_MASKS,
+    Draw,
     animate_bezier_point,
     animate_ellipsis_blur,
     draw_fading_bezier_curve,
@@ -18,14 +50,17 @@ from src.graph_stuff import (
     get_node_positions,
 )
 from src.midi_stuff import (
+    NoteStore,
     get_note_start_times_in_frames,
     TRACK_NOTE_DELIMITER,
 )
-from src.theme_stuff import Theme
+from src.theme_stuff import Theme, ThemeError
 from src.video_stuff import (
     add_frame_to_video,
     finalize_video_with_music,
+    prepare_music,
     initialize_video_writer,
+    resolution_suffix,
 )
 
 
@@ -40,8 +75,42 @@ def overlapping_pairs(lst):
     return list(zip(lst, lst[1:])) + [(lst[-1], lst[0])] if len(lst) > 1 else []
 
 
-def create_graphviz_default_sort(theme, track_events_frames):
+def aggregate_song_graph(theme, note_store):
+    """
+    Collect the song graph's nodes and edges in Python, so that each one is only passed to Graphviz once.
+    Returns:
+        nodes - every node key, in the order Graphviz would first have seen it
+        roots - the first note of every chord, in order
+        edge_weights - {(a, b): how many times the song moves between a and b, in either direction}
+    """
+    nodes = {}
+    roots = {}
+    edge_weights = {}
+
+    for track in note_store.tracks:
+        if theme.skip_track(track):
+            continue
+        notes = [note_store.node_keys(chord) for _, chord in note_store.chords(track)]
+        for note in notes:
+            nodes.setdefault(note[0], True)
+            roots.setdefault(note[0], True)
+
+        melody_pairs = overlapping_pairs(notes)
+        for a_notes, b_notes in melody_pairs:
+            for a in a_notes:
+                for b in b_notes:
+                    nodes.setdefault(b, True)
+                    nodes.setdefault(a, True)
+                    edge = (b, a) if (b, a) in edge_weights else (a, b)
+                    edge_weights[edge] = edge_weights.get(edge, 0) + 1
+
+    return list(nodes), list(roots), edge_weights
+
+
+def create_graphviz_default_sort(theme, nodes, edge_weights):
     """Create a Graphviz without a specified order"""
+    from graphviz import Graph
+
     song_graph = Graph(
         "G",
         engine=theme.graphviz_engine,
@@ -52,25 +121,13 @@ def create_graphviz_default_sort(theme, track_events_frames):
         edge_attr=theme.graphviz_edge_attrs,
     )
 
-    for track, note_tuples in track_events_frames.items():
-        if theme.skip_track(track):
-            continue
-        notes = [
-            [note_tuple[0] for note_tuple in list_of_note_tuples]
-            for frame_num, list_of_note_tuples in note_tuples.items()
-        ]
-        # Create Nodes
-        for note in notes:
-            n = note[0]
-            song_graph.node(n, label=midi_note_to_pitch_class(n))
+    # Create Nodes
+    for n in nodes:
+        song_graph.node(n, label=midi_note_to_pitch_class(n))
 
-        # Create Edges
-        melody_pairs = overlapping_pairs(notes)
-        for a_notes, b_notes in melody_pairs:
-            for a in a_notes:
-                for b in b_notes:
-                    song_graph.node(b, label=midi_note_to_pitch_class(b))
-                    song_graph.edge(a, b)
+    # Create Edges
+    for a, b in edge_weights:
+        song_graph.edge(a, b)
 
     return song_graph
 
@@ -90,22 +147,21 @@ def filter_and_order_custom(reference_list, input_list):
     return ordered_list
 
 
-def create_graphviz_sorted(theme, track_events_frames):
+def create_graphviz_sorted(theme, nodes, roots, edge_weights, order=None):
     """
     This function implements a hack to force Graphviz node ordering.
     Step 1: Create a bare-bones CIRCO graph with nodes added in order
     Step 2: Save that graph to a file, and extract its node positions
     Step 3: Generate the final NEATO graph, using hard coded node positions
+    `order` lists the pitch classes (1 to 12) to go around the circle, in place of the theme's `nodes_sorted`.
     """
-    if theme.graphviz_engine.lower() != "circo":
-        click.echo(
-            "ERROR: Node sorting only works when graphviz engine is circo", err=True
-        )
-        cleanup_cache_dir(get_cache_dir())
-        exit(1)
+    if order is None and theme.graphviz_engine.lower() != "circo":
+        raise ThemeError("Node sorting only works when graphviz engine is circo")
+    from graphviz import Graph
+
     song_graph = Graph(
         "G",
-        engine=theme.graphviz_engine,
+        engine="circo",
         format="plain",
         strict=True,
         node_attr=theme.graphviz_node_attrs,
@@ -113,23 +169,12 @@ def create_graphviz_sorted(theme, track_events_frames):
         edge_attr=theme.graphviz_edge_attrs,
     )
 
-    all_notes = {}
-
-    for track, note_tuples in track_events_frames.items():
-        if theme.skip_track(track):
-            continue
-        notes = [
-            [note_tuple[0] for note_tuple in list_of_note_tuples]
-            for frame_num, list_of_note_tuples in note_tuples.items()
-        ]
-
-        for note in notes:
-            all_notes[note[0]] = True
-
     # Create Nodes - In order
     prev_note = None
-    all_notes = list(all_notes.keys())
-    if theme.nodes_sorted:
+    all_notes = roots
+    if order is not None:
+        all_notes = filter_and_order_custom(order, all_notes)
+    elif theme.nodes_sorted:
         if isinstance(theme.nodes_sorted, bool):
             all_notes = sorted(
                 all_notes, key=lambda i: int(i.split(TRACK_NOTE_DELIMITER)[1])
@@ -154,279 +199,925 @@ def create_graphviz_sorted(theme, track_events_frames):
         edge_attr=theme.graphviz_edge_attrs,
     )
 
-    for track, note_tuples in track_events_frames.items():
-        if theme.skip_track(track):
-            continue
-        notes = [
-            [note_tuple[0] for note_tuple in list_of_note_tuples]
-            for frame_num, list_of_note_tuples in note_tuples.items()
-        ]
-        # Create Nodes
-        for note in notes:
-            n = note[0]
+    # Create Nodes, the first note of each chord is pinned to its place in the circle
+    for n in nodes:
+        if n in node_positions:
             song_graph.node(
                 n,
                 label=midi_note_to_pitch_class(n),
                 _attributes={"pos": node_positions[n]},
             )
+        else:
+            song_graph.node(n, label=midi_note_to_pitch_class(n))
 
-        # Create Edges
-        melody_pairs = overlapping_pairs(notes)
-        for a_notes, b_notes in melody_pairs:
-            for a in a_notes:
-                for b in b_notes:
-                    song_graph.node(b, label=midi_note_to_pitch_class(b))
-                    song_graph.edge(a, b)
+    # Create Edges
+    for a, b in edge_weights:
+        song_graph.edge(a, b)
 
     return song_graph
 
 
-def create_graphviz(theme, track_events_frames):
+def layout_graphviz(theme, nodes, roots, edge_weights):
     if theme.nodes_sorted:
-        return create_graphviz_sorted(theme, track_events_frames)
+        return create_graphviz_sorted(theme, nodes, roots, edge_weights)
+
+    return create_graphviz_default_sort(theme, nodes, edge_weights)
 
-    return create_graphviz_default_sort(theme, track_events_frames)
 
+def process_frame(
+    current_frame,
+    compositor,
+    theme,
+    offsets,
+    FRAMES,
+    frame_cache=None,
+    layer_groups=None,
+):
+    compositor.reset()
+    draw_list = FRAMES.frame(current_frame)
+    if frame_cache:
+        key = frame_cache.key(draw_list)
+        if frame_cache.load(key, compositor):
+            return compositor.frame
 
-def process_frame(current_frame, base_image, theme, offsets, FRAMES):
-    frame_result = base_image.copy()
-    for layer, layer_images in sorted(FRAMES.items()):
-        frame = layer_images[current_frame]
-        if frame:
-            draw_function, args = frame
-            frame_result = draw_function(
-                base_image=frame_result,  # Use frame_result instead of base_image
+    if layer_groups:
+        layer_groups.draw(draw_list, compositor)
+    else:
+        for draw_function, args in draw_list:
+            patch = draw_function(
                 theme=theme,
                 offsets=offsets,
                 **args,
             )
-    return frame_result
+            if patch:
+                compositor.blend(*patch)
 
+    if frame_cache:
+        frame_cache.store(key, compositor)
+    return compositor.frame
 
-def generate_music_graph(
-    midi_file_path,
-    default_theme_file_path,
-    theme_file_path,
-    output_path,
-    soundfont_file,
-):
-    theme = Theme(theme_file_path, default_theme_file_path)
-    track_events_frames = get_note_start_times_in_frames(
-        midi_file_path,
-        theme.frame_rate,
-        squash_tracks=theme.squash_tracks,
-        group_notes_by_track=theme.group_notes_by_track,
-    )
 
-    click.echo("Creating Graph...")
-    song_graph = create_graphviz(theme, track_events_frames)
+def plan_pulses(frames, track, nodes, curr_frame, curr_note_tuples):
+    """Animate the Node pulses of a chord, `curr_note_tuples` are (note, velocity, length in frames)"""
+    for current_note, curr_note_velocity, curr_note_frame_len in curr_note_tuples:
+        frames.add_animation(
+            f"l2-{track}-{current_note}",
+            curr_frame,
+            curr_note_frame_len,
+            animate_ellipsis_blur,
+            {
+                "track": track,
+                "points": nodes[current_note].e_points,
+                "animation_len": curr_note_frame_len,
+                "velocity": curr_note_velocity,
+            },
+        )
 
-    base_image, nodes, edges, offsets = parse_graph(song_graph, theme)
 
-    if theme.debug_show_base_image:
-        base_image.show()
-        cleanup_cache_dir(get_cache_dir())
-        exit()
+def plan_chord_lines(frames, theme, track, edges, curr_frame, curr_note_tuples):
+    """Animate the Chord Lines between the notes of a chord"""
+    if len(curr_note_tuples) < 2:
+        return
 
-    FRAMES = AnimationFrames()
+    # Split notes in chord up by the frame length, cause multiple chords might be playing
+    notes_in_cords = {}
+    for note, velocity, frame_len in curr_note_tuples:
+        if frame_len not in notes_in_cords:
+            notes_in_cords[frame_len] = []
+        notes_in_cords[frame_len].append(note)
 
-    click.echo("Planning out frames...", nl=False)
+    # For each individual chord, draw the lines
+    for frame_len, all_notes in notes_in_cords.items():
+        # The chord lines should not overlap, so sort them according to sort order
+        if theme.nodes_sorted:
+            if isinstance(theme.nodes_sorted, bool):
+                all_notes = sorted(
+                    all_notes,
+                    key=lambda i: int(i.split(TRACK_NOTE_DELIMITER)[1]),
+                )
+            else:
+                all_notes = filter_and_order_custom(theme.nodes_sorted, all_notes)
+        # Use `overlapping_pairs` to make the notes connect as a circle
+        pairs = overlapping_pairs(all_notes)
+        for a, b in pairs:
+            if b not in edges[a]:
+                continue
+            if a == b and not theme.allow_self_notes(track):
+                continue
+            frames.add_animation(
+                f"l1-{track}-{a}-{b}-line",
+                curr_frame,
+                frame_len,
+                draw_fading_bezier_curve,
+                {
+                    "track": track,
+                    "points": edges[a][b].b_points,
+                    "animation_len": frame_len,
+                },
+            )
 
-    for track in track_events_frames.keys():
-        if theme.skip_track(track):
-            continue
-        curr_track = track_events_frames[track]
-        curr_frame = min(curr_track) - 1
-        prev_notes = None
-        prev_notes_frame = None
-        num_notes_processed = 0
-        click.echo()  # NL
 
-        max_notes = len(track_events_frames[track])
+def plan_balls(
+    frames, theme, track, edges, prev_notes, curr_notes, start_frame, length
+):
+    """Animate the "next note" balls, travelling from the previous chord to the current one"""
+    drawn_to = set()
+    source_usage = {note: 0 for note in prev_notes}
 
-        while num_notes_processed < max_notes and curr_frame <= max(curr_track):
-            curr_frame += 1
+    # New Rule: Check if there are more destinations than sources to determine max usage
+    max_usage = 2 if len(curr_notes) > len(prev_notes) else 1
 
-            if curr_frame not in curr_track:
+    for a in prev_notes:
+        for b in curr_notes:
+            if (
+                b in drawn_to
+                or (a == b and not theme.allow_self_notes(track))
+                or source_usage[a] >= max_usage
+                or b not in edges[a]
+            ):
                 continue
 
-            usage = size(psutil.Process().memory_info().rss)
-            click.echo(
-                f"\r[{track}] Processing {num_notes_processed + 1} of {max_notes} notes... (memory usage={usage})",
-                nl=False,
+            frames.add_animation(
+                f"l3-{track}-{a}-{b}-balls",
+                start_frame,
+                length,
+                animate_bezier_point,
+                {
+                    "track": track,
+                    "points": edges[a][b].b_points,
+                    "animation_length_in_frames": length,
+                },
             )
+            drawn_to.add(b)
+            source_usage[a] += 1
+
 
-            num_notes_processed += 1
-            curr_note_tuples = curr_track[curr_frame]
-
-            # Animate the Node pulses
-            for (
-                current_note,
-                curr_note_velocity,
-                curr_note_frame_len,
-            ) in curr_note_tuples:
-                frames = []
-                for i in range(curr_note_frame_len):
-                    frame = [
-                        animate_ellipsis_blur,
-                        {
-                            "track": track,
-                            "points": nodes[current_note].e_points,
-                            "frame_number": i,
-                            "animation_len": curr_note_frame_len,
-                            "velocity": curr_note_velocity,
-                        },
-                    ]
-
-                    frames.append(frame)
-                FRAMES.add_frames_to_layer(
-                    f"l2-{track}-{current_note}", curr_frame, frames
+def iter_track_plan(track, note_store, theme, nodes, edges, track_frames):
+    """
+    Plan the animations of one track into `track_frames`, one chord at a time.
+    After each chord, yields the frame before which every animation of the track has been planned.
+    """
+    prev_notes = None
+    prev_notes_frame = None
+
+    for curr_frame, chord in note_store.chords(track):
+        curr_note_tuples = list(
+            zip(
+                note_store.node_keys(chord),
+                chord["velocity"].tolist(),
+                chord["length_frames"].tolist(),
+            )
+        )
+
+        plan_pulses(track_frames, track, nodes, curr_frame, curr_note_tuples)
+
+        if theme.pulses_only(track):
+            yield curr_frame
+            continue
+
+        plan_chord_lines(
+            track_frames, theme, track, edges, curr_frame, curr_note_tuples
+        )
+
+        curr_notes = [curr_note_tuple[0] for curr_note_tuple in curr_note_tuples]
+
+        if prev_notes:
+            animation_length_in_frames = curr_frame - prev_notes_frame
+            if animation_length_in_frames / theme.frame_rate <= 10:
+                plan_balls(
+                    track_frames,
+                    theme,
+                    track,
+                    edges,
+                    prev_notes,
+                    curr_notes,
+                    prev_notes_frame,
+                    animation_length_in_frames,
                 )
 
-            if theme.pulses_only(track):
-                continue
+        prev_notes = curr_notes
+        prev_notes_frame = curr_frame
 
-            # Animate the Chord Lines
-            if len(curr_note_tuples) > 1:
-                # Split notes in chord up by the frame length, cause multiple chords might be playing
-                notes_in_cords = {}
-                for note, velocity, frame_len in curr_note_tuples:
-                    if frame_len not in notes_in_cords:
-                        notes_in_cords[frame_len] = []
-                    notes_in_cords[frame_len].append(note)
-
-                # For each individual chord, draw the lines
-                for frame_len, all_notes in notes_in_cords.items():
-                    # The chord lines should not overlap, so sort them according to sort order
-                    if theme.nodes_sorted:
-                        if isinstance(theme.nodes_sorted, bool):
-                            all_notes = sorted(
-                                all_notes,
-                                key=lambda i: int(i.split(TRACK_NOTE_DELIMITER)[1]),
-                            )
-                        else:
-                            all_notes = filter_and_order_custom(
-                                theme.nodes_sorted, all_notes
-                            )
-                    # Use `overlapping_pairs` to make the notes connect as a circle
-                    pairs = overlapping_pairs(all_notes)
-                    for a, b in pairs:
-                        frames = []
-                        for i in range(frame_len):
-                            if b not in edges[a]:
-                                continue
-                            if a == b and not theme.allow_self_notes(track):
-                                continue
-                            frames.append(
-                                [
-                                    draw_fading_bezier_curve,
-                                    {
-                                        "track": track,
-                                        "points": edges[a][b].b_points,
-                                        "frame_number": i,
-                                        "animation_len": frame_len,
-                                    },
-                                ]
-                            )
-                        FRAMES.add_frames_to_layer(
-                            f"l1-{track}-{a}-{b}-line", curr_frame, frames
-                        )
+        # The balls of this chord are only planned once the next chord is known
+        yield curr_frame
+
+
+def plan_track(track, note_store, theme, nodes, edges):
+    """Plan the animations of one track, tracks are independent so they can be planned in separate processes"""
+    track_frames = AnimationFrames()
+    for _ in iter_track_plan(track, note_store, theme, nodes, edges, track_frames):
+        pass
+    return track_frames
+
+
+def plan_frames(theme, note_store, nodes, edges, executor=None, on_track_planned=None):
+    """
+    Plan every track and merge them into one timeline.
+    With a process pool `executor`, tracks are planned in parallel.
+    """
+    tracks = [track for track in note_store.tracks if not theme.skip_track(track)]
+    # Start the busiest tracks first, so they don't end up running alone at the end
+    tracks = sorted(tracks, key=lambda t: len(note_store.notes(t)), reverse=True)
+
+    FRAMES = AnimationFrames()
+    if executor is None or len(tracks) <= 1:
+        for track in tracks:
+            FRAMES.merge(plan_track(track, note_store, theme, nodes, edges))
+            if on_track_planned:
+                on_track_planned(track)
+        return FRAMES
+
+    future_to_track = {
+        executor.submit(
+            plan_track,
+            track,
+            NoteStore({track: note_store.notes(track)}),
+            theme,
+            nodes,
+            edges,
+        ): track
+        for track in tracks
+    }
+    for future in as_completed(future_to_track):
+        track = future_to_track[future]
+        FRAMES.merge(future.result())
+        if on_track_planned:
+            on_track_planned(track)
+
+    return FRAMES
+
+
+class StreamedPlan:
+    """
+    Plans all tracks chord by chord, only as far ahead as the frames being drawn need,
+    so the first frames can be drawn right after the layout is done.
+    Tells `frames` how far planning has got, so it can spill the frames it is done with.
+    """
+
+    def __init__(
+        self, theme, note_store, nodes, edges, frames=None, on_track_planned=None
+    ):
+        self.frames = frames if frames is not None else AnimationFrames()
+        self.on_track_planned = on_track_planned
+        tracks = [track for track in note_store.tracks if not theme.skip_track(track)]
+        self._planners = {
+            track: iter_track_plan(track, note_store, theme, nodes, edges, self.frames)
+            for track in tracks
+        }
+        self._planned_until = {track: 0 for track in tracks}
+
+    def _plan_next_chord(self):
+        track = min(self._planned_until, key=self._planned_until.get)
+        try:
+            self._planned_until[track] = next(self._planners[track])
+        except StopIteration:
+            del self._planners[track]
+            del self._planned_until[track]
+            if self.on_track_planned:
+                self.on_track_planned(track)
+        # Nothing is planned before the track that is furthest behind
+        self.frames.planned_until(
+            min(self._planned_until.values(), default=len(self.frames))
+        )
+
+    def has_frame(self, frame_index):
+        """Plan until `frame_index` can be drawn, False if the song ends before it"""
+        while self._planners and min(self._planned_until.values()) <= frame_index:
+            self._plan_next_chord()
+        return frame_index < len(self.frames)
+
+    def plan_all(self):
+        while self._planners:
+            self._plan_next_chord()
+        return self.frames
+
+
+def worker_process_context():
+    """
+    Worker processes start from a clean process instead of a fork: forking while
+    another thread holds a lock can deadlock the children.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+# `timings` are the seconds spent in each stage of the render.
+# `output_paths` has the output of each resolution, by "WIDTHxHEIGHT", `output_path` is the largest one
+RenderResult = namedtuple(
+    "RenderResult", "output_path frames_written timings output_paths"
+)
+
+# Base images of the most recent layouts are kept, they are reused when a theme is tweaked or a song re-rendered
+MAX_CACHED_LAYOUTS = 8
+
+# The on-disk layouts are shared by every render on this host, the least recently used go past this size
+MAX_LAYOUT_CACHE_BYTES = 256 * 1024 * 1024
+
+# Bump this whenever the layout, the drawing of the base image or the way they are saved changes
+LAYOUT_CACHE_VERSION = 3
+
+
+def save_layout(path, layout):
+    """
+    Save a (base_image, nodes, edges, offsets) layout as `<path>.npy`, the base image's pixels,
+    and `<path>.json`, the node and edge drawings. The JSON is written last, so a layout is only visible once it is complete.
+    """
+    base_image, nodes, edges, offsets = layout
+    edge_list = [
+        [a, b, draw._asdict()]
+        for a, b_draws in edges.items()
+        for b, draw in b_draws.items()
+        # Both directions share one drawing
+        if a <= b
+    ]
+
+    with atomic_write_path(f"{path}.npy") as temp_path:
+        with open(temp_path, "wb") as f:
+            np.save(f, np.asarray(base_image.convert("RGBA")), allow_pickle=False)
+    with atomic_write_path(f"{path}.json") as temp_path:
+        with open(temp_path, "w") as f:
+            json.dump(
+                {
+                    "version": LAYOUT_CACHE_VERSION,
+                    "nodes": {name: draw._asdict() for name, draw in nodes.items()},
+                    "edges": edge_list,
+                    "offsets": list(offsets),
+                },
+                f,
+            )
 
-            curr_notes = [curr_note_tuple[0] for curr_note_tuple in curr_note_tuples]
-
-            # Animate the "next note" balls
-            if prev_notes:
-                animation_length_in_frames = curr_frame - prev_notes_frame
-                drawn_to = set()
-                source_usage = {note: 0 for note in prev_notes}
-
-                # New Rule: Check if there are more destinations than sources to determine max usage
-                max_usage = 2 if len(curr_notes) > len(prev_notes) else 1
-
-                if animation_length_in_frames / theme.frame_rate <= 10:
-                    for a in prev_notes:
-                        for b in curr_notes:
-                            if (
-                                b in drawn_to
-                                or (a == b and not theme.allow_self_notes(track))
-                                or source_usage[a] >= max_usage
-                                or b not in edges[a]
-                            ):
-                                continue
-
-                            frames = []
-                            for i in range(animation_length_in_frames):
-                                frame = [
-                                    animate_bezier_point,
-                                    {
-                                        "track": track,
-                                        "points": edges[a][b].b_points,
-                                        "frame_number": i,
-                                        "animation_length_in_frames": animation_length_in_frames,
-                                    },
-                                ]
-
-                                frames.append(frame)
-                            FRAMES.add_frames_to_layer(
-                                f"l3-{track}-{a}-{b}-balls", prev_notes_frame, frames
-                            )
-                            drawn_to.add(b)
-                            source_usage[a] += 1
-
-            prev_notes = curr_notes
-            prev_notes_frame = curr_frame
-
-    num_frames = len(FRAMES)
-    if theme.debug_max_frames:
-        num_frames = theme.debug_max_frames
-
-    writer_context = initialize_video_writer(theme.frame_rate)
-    frames_written = 0
-    click.echo("\nDrawing frames, writing videos...")
-    NUM_WORKERS = os.cpu_count()
+
+def load_layout(path):
+    """Load a layout written by `save_layout`, returns None if there isn't a compatible one"""
     try:
-        with writer_context as (writer, video_file_path):
-            while frames_written < num_frames:
-                with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-                    future_to_frame = {
-                        executor.submit(
+        with open(f"{path}.json") as f:
+            index = json.load(f)
+        if index["version"] != LAYOUT_CACHE_VERSION:
+            return None
+        pixels = np.load(f"{path}.npy", allow_pickle=False)
+        nodes = {name: Draw(**draw) for name, draw in index["nodes"].items()}
+        edges = defaultdict(dict)
+        for a, b, draw in index["edges"]:
+            edges[a][b] = edges[b][a] = Draw(**draw)
+        offsets = tuple(index["offsets"])
+        # Marks the layout as recently used, for trim_cache_dir
+        os.utime(f"{path}.json")
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return Image.fromarray(pixels, "RGBA"), nodes, edges, offsets
+
+
+class Renderer:
+    """
+    Renders songs, keeping the worker pools, sprite caches and graph layouts warm between songs.
+    Progress is reported to `on_progress(stage, done, total)`, and errors are raised as exceptions.
+    Stages are "notes", "graph", "planning", "drawing" and "music", `total` is None when it isn't known yet.
+    `dry_run` only reports "notes", "graph", "planning", and "calibrating" when it calibrates.
+    With a frame cache, "frame_cache" reports how many of the frames were loaded from it.
+    Frames are drawn once at the theme's size, and scaled down for each of the smaller `resolutions`.
+    Structured events about each render are sent to `telemetry`, see `Telemetry`.
+    Tracks are planned in worker processes, see `plan` for what that asks of the calling script.
+    """
+
+    def __init__(self, num_workers=None, on_progress=None, telemetry=None):
+        self.num_workers = num_workers or os.cpu_count()
+        self.on_progress = on_progress
+        self.telemetry = telemetry or Telemetry()
+        self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        # The music is synthesized and encoded while the frames are drawn
+        self._music_executor = ThreadPoolExecutor(max_workers=1)
+        self._planning_executor = None
+        self._layouts = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown()
+        self._music_executor.shutdown()
+        if self._planning_executor:
+            self._planning_executor.shutdown()
+
+    def _progress(self, stage, done=0, total=None):
+        if self.on_progress:
+            self.on_progress(stage, done, total)
+
+    def layout(self, theme, note_store):
+        """
+        Lay out the song graph and draw its base image, returns (base_image, nodes, edges, offsets, edge_weights),
+        where edge_weights counts the transitions along each edge of the graph.
+        Layouts are cached in memory, and on disk for other processes.
+        """
+        nodes, roots, edge_weights = aggregate_song_graph(theme, note_store)
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    LAYOUT_CACHE_VERSION,
+                    theme.fingerprint,
+                    # The theme only names these files, the base image depends on what is in them
+                    file_signature(theme.font),
+                    file_signature(theme.background_image),
+                    nodes,
+                    roots,
+                    list(edge_weights),
+                ]
+            ).encode()
+        ).hexdigest()
+        if key in self._layouts:
+            self._layouts.move_to_end(key)
+            return (*self._layouts[key], edge_weights)
+
+        layout_cache_dir = get_layout_cache_dir()
+        path = os.path.join(layout_cache_dir, key)
+        layout = load_layout(path)
+        if layout is None:
+            song_graph = layout_graphviz(theme, nodes, roots, edge_weights)
+            layout = parse_graph(song_graph, theme)
+            save_layout(path, layout)
+            trim_cache_dir(layout_cache_dir, MAX_LAYOUT_CACHE_BYTES, keep={key})
+
+        self._layouts[key] = layout
+        while len(self._layouts) > MAX_CACHED_LAYOUTS:
+            self._layouts.popitem(last=False)
+        return (*layout, edge_weights)
+
+    def plan(self, theme, note_store, nodes, edges, budget=None):
+        """
+        Plan the song's frames. Tracks are planned in parallel, unless there is a memory budget:
+        then they are planned together chord by chord, and the frames planning is done with
+        are spilled to disk as soon as the plan outgrows its share of the budget.
+        The planning workers import the main module afresh, so a script that plans (or renders)
+        in parallel has to keep its top-level code under `if __name__ == "__main__":`.
+        """
+        num_tracks = len(
+            [track for track in note_store.tracks if not theme.skip_track(track)]
+        )
+        planned = []
+
+        def on_track_planned(track):
+            planned.append(track)
+            self._progress("planning", len(planned), num_tracks)
+
+        self._progress("planning", 0, num_tracks)
+
+        if budget and budget.max_bytes:
+            frames = AnimationFrames()
+            frames.spill_as_planned(
+                os.path.join(get_cache_dir(), "frames"), budget.should_spill_plan
+            )
+            return StreamedPlan(
+                theme,
+                note_store,
+                nodes,
+                edges,
+                frames=frames,
+                on_track_planned=on_track_planned,
+            ).plan_all()
+
+        executor = None
+        if min(self.num_workers, len(note_store.tracks)) > 1:
+            if self._planning_executor is None:
+                # By now the music is being prepared on another thread
+                self._planning_executor = ProcessPoolExecutor(
+                    max_workers=self.num_workers,
+                    mp_context=worker_process_context(),
+                )
+            executor = self._planning_executor
+
+        return plan_frames(
+            theme,
+            note_store,
+            nodes,
+            edges,
+            executor=executor,
+            on_track_planned=on_track_planned,
+        )
+
+    def dry_run(
+        self,
+        midi_file_path,
+        default_theme_file_path,
+        theme_file_path,
+        max_memory=None,
+        calibrate_costs=False,
+    ):
+        """
+        Read, lay out and plan a song without drawing it, and report what rendering it would take:
+        frames, layers per frame, draws by draw function, peak memory and an ETA for drawing the frames.
+        With `calibrate_costs`, a sample of the frames is drawn to measure the draw costs on this machine,
+        and the measured costs are saved for later dry runs.
+        """
+        try:
+            return self._dry_run(
+                midi_file_path,
+                default_theme_file_path,
+                theme_file_path,
+                max_memory,
+                calibrate_costs,
+            )
+        finally:
+            cleanup_cache_dir(get_cache_dir())
+
+    def _dry_run(
+        self,
+        midi_file_path,
+        default_theme_file_path,
+        theme_file_path,
+        max_memory,
+        calibrate_costs,
+    ):
+        theme = Theme(theme_file_path, default_theme_file_path)
+        self._progress("notes")
+        note_store = get_note_start_times_in_frames(
+            midi_file_path,
+            theme.frame_rate,
+            squash_tracks=theme.squash_tracks,
+            group_notes_by_track=theme.group_notes_by_track,
+        )
+        self._progress("graph")
+        base_image, nodes, edges, offsets, edge_weights = self.layout(theme, note_store)
+        # Planned as the render would, so the memory in use afterwards is what the render's would be
+        FRAMES = self.plan(theme, note_store, nodes, edges, MemoryBudget(max_memory))
+        num_frames = len(FRAMES)
+        if theme.debug_max_frames:
+            num_frames = min(num_frames, theme.debug_max_frames)
+
+        report = plan_stats(FRAMES, num_frames)
+        report["seconds"] = round(num_frames / theme.frame_rate, 2)
+        report["edges"] = len(edge_weights)
+        report["transitions"] = sum(edge_weights.values())
+        report["tracks"] = len(
+            [track for track in note_store.tracks if not theme.skip_track(track)]
+        )
+        report["estimated_peak_memory"] = estimate_peak_memory(
+            theme, FRAMES, self.num_workers, max_memory
+        )
+
+        if calibrate_costs:
+            self._progress("calibrating")
+            base_frame = premultiply(np.asarray(base_image.convert("RGBA")))
+            model = calibrate(FRAMES, num_frames, theme, offsets, base_frame)
+            save_cost_model(model)
+            calibrated = True
+        else:
+            model, calibrated = load_cost_model()
+        report["cost_model"] = "calibrated" if calibrated else "default"
+        report["estimated_seconds"] = round(
+            estimate_seconds(report, model, self.num_workers), 1
+        )
+        self.telemetry.emit("dry_run", midi=midi_file_path, **report)
+        return report
+
+    def render(
+        self,
+        midi_file_path,
+        default_theme_file_path,
+        theme_file_path,
+        output_path,
+        soundfont_file,
+        encoder="ffmpeg",
+        codec=DEFAULT_CODEC,
+        preset=DEFAULT_PRESET,
+        crf=DEFAULT_CRF,
+        encoder_threads=0,
+        max_memory=None,
+        frame_cache_size=None,
+        resolutions=None,
+    ):
+        self.telemetry.emit(
+            "render_start",
+            midi=midi_file_path,
+            theme=theme_file_path,
+            encoder=encoder,
+            workers=self.num_workers,
+        )
+        try:
+            result = self._render(
+                midi_file_path,
+                default_theme_file_path,
+                theme_file_path,
+                output_path,
+                soundfont_file,
+                encoder,
+                codec,
+                preset,
+                crf,
+                encoder_threads,
+                max_memory,
+                frame_cache_size,
+                resolutions,
+            )
+        except Exception as e:
+            self.telemetry.emit("render_failed", error=str(e) or type(e).__name__)
+            raise
+        finally:
+            cleanup_cache_dir(get_cache_dir())
+        self.telemetry.emit(
+            "render_end",
+            frames=result.frames_written,
+            output_paths=result.output_paths,
+            timings={
+                stage: round(seconds, 4) for stage, seconds in result.timings.items()
+            },
+        )
+        return result
+
+    def _render(
+        self,
+        midi_file_path,
+        default_theme_file_path,
+        theme_file_path,
+        output_path,
+        soundfont_file,
+        encoder,
+        codec,
+        preset,
+        crf,
+        encoder_threads,
+        max_memory,
+        frame_cache_size,
+        resolutions,
+    ):
+        timings = {}
+        start = time.perf_counter()
+        stage_start = start
+
+        def start_stage(stage):
+            self.telemetry.stage_start(stage)
+
+        def end_stage(stage):
+            nonlocal stage_start
+            now = time.perf_counter()
+            timings[stage] = now - stage_start
+            stage_start = now
+            self.telemetry.stage_end(stage, timings[stage])
+
+        budget = MemoryBudget(max_memory)
+        theme = Theme(theme_file_path, default_theme_file_path)
+        resolutions = check_resolutions(
+            resolutions or [(theme.width, theme.height)],
+            (theme.width, theme.height),
+            encoder,
+        )
+        if len(resolutions) > 1 and encoder in STREAM_ENCODERS:
+            raise ValueError(f"The {encoder} encoder can only stream one resolution")
+        start_stage("notes")
+        self._progress("notes")
+        note_store = get_note_start_times_in_frames(
+            midi_file_path,
+            theme.frame_rate,
+            squash_tracks=theme.squash_tracks,
+            group_notes_by_track=theme.group_notes_by_track,
+        )
+        end_stage("notes")
+
+        music_future = None
+        if encoder in VIDEO_FILE_ENCODERS and not theme.debug_show_base_image:
+            music_future = self._music_executor.submit(
+                prepare_music, midi_file_path, soundfont_file
+            )
+
+        start_stage("graph")
+        self._progress("graph")
+        base_image, nodes, edges, offsets, _ = self.layout(theme, note_store)
+        end_stage("graph")
+
+        if theme.debug_show_base_image:
+            base_image.show()
+            return RenderResult(None, 0, timings, {})
+
+        start_stage("planning")
+        if encoder in STREAM_ENCODERS:
+            # Frames go out while the rest of the song is still being planned
+            streamed_plan = StreamedPlan(theme, note_store, nodes, edges)
+            FRAMES = streamed_plan.frames
+            num_frames = None
+
+            def has_frame(frame_index):
+                if theme.debug_max_frames and frame_index >= theme.debug_max_frames:
+                    return False
+                return streamed_plan.has_frame(frame_index)
+
+        else:
+            FRAMES = self.plan(theme, note_store, nodes, edges, budget)
+            num_frames = len(FRAMES)
+            if theme.debug_max_frames:
+                num_frames = theme.debug_max_frames
+
+            def has_frame(frame_index):
+                return frame_index < num_frames
+
+        end_stage("planning")
+
+        encoder_options = {}
+        if encoder in VIDEO_FILE_ENCODERS:
+            encoder_options = dict(
+                codec=codec,
+                preset=preset,
+                crf=crf,
+                threads=encoder_threads,
+            )
+        writer_context = initialize_video_writer(
+            theme.frame_rate,
+            base_image.size,
+            encoder=encoder,
+            output_path=f"{output_path}_frames",
+            resolutions=resolutions,
+            **encoder_options,
+        )
+
+        # Reusable frame buffers, all starting from the same base frame.
+        # A frame holds its buffer from when it is submitted until it is encoded,
+        # so the number of buffers bounds the number of frames in flight.
+        base_frame = premultiply(np.asarray(base_image.convert("RGBA")))
+        max_in_flight = budget.max_frames_in_flight(
+            base_frame.nbytes, default=self.num_workers * 2
+        )
+        free_compositors = [FrameCompositor(base_frame) for _ in range(max_in_flight)]
+        frame_cache = None
+        if frame_cache_size:
+            frame_cache = FrameCache(theme, base_frame, offsets, frame_cache_size)
+        ELLIPSE_MASKS.resize(budget.ellipse_mask_bytes(ELLIPSE_MASK_CACHE_BYTES))
+        layer_groups = None
+        if theme.layer_groups:
+            layer_groups = LayerGroups(
+                theme, offsets, budget.layer_group_bytes(LAYER_GROUP_CACHE_BYTES)
+            )
+        in_flight = deque()
+        next_frame = 0
+        frames_written = 0
+        start_stage("drawing")
+        self._progress("drawing", 0, num_frames)
+
+        def drawing_stats():
+            stats = {
+                "frames": frames_written,
+                "total": num_frames,
+                "in_flight": len(in_flight),
+                "encode_seconds": round(writer.encode_seconds, 4),
+            }
+            if frame_cache:
+                stats["frame_cache_hit_rate"] = hit_rate(frame_cache)
+            if layer_groups:
+                stats["layer_group_hit_rate"] = hit_rate(layer_groups)
+            return stats
+
+        try:
+            with writer_context as (writer, video_file_paths):
+                while True:
+                    # Renderers may only get ahead of the encoder while buffers are free and memory allows it
+                    throttled = in_flight and budget.over_budget()
+                    while free_compositors and not throttled and has_frame(next_frame):
+                        compositor = free_compositors.pop()
+                        future = self._executor.submit(
                             process_frame,
-                            current_frame=i,
-                            base_image=base_image.copy(),
+                            current_frame=next_frame,
+                            compositor=compositor,
                             theme=theme,
                             offsets=offsets,
                             FRAMES=FRAMES,
-                        ): i
-                        for i in range(
-                            frames_written, min(frames_written + NUM_WORKERS, num_frames)
+                            frame_cache=frame_cache,
+                            layer_groups=layer_groups,
                         )
-                    }
-
-                    results = []
-                    for future in as_completed(future_to_frame):
-                        frame_index = future_to_frame[future]
-                        frame_image = future.result()
-                        results.append((frame_index, frame_image))
-
-                    for frame_index, frame_image in sorted(results, key=lambda x: x[0]):
-                        add_frame_to_video(writer, frame_image)
-                        frames_written += 1
-
-                    usage = size(psutil.Process().memory_info().rss)
-                    click.echo(
-                        f"\rProcessed {frames_written} of {num_frames}... (memory usage={usage})",
-                        nl=False,
-                    )
-    except KeyboardInterrupt:
-        click.echo(f"\nOk, let's just make the video now!")
-        pass
+                        in_flight.append((future, compositor))
+                        next_frame += 1
 
-    finalize_video_with_music(
-        writer,
-        video_file_path,
-        output_path,
-        midi_file_path,
-        theme.frame_rate,
-        soundfont_file,
-        frames_written,
+                    if not in_flight:
+                        break
+
+                    # Frames are encoded in order, as soon as the oldest one is ready
+                    future, compositor = in_flight.popleft()
+                    add_frame_to_video(writer, future.result())
+                    free_compositors.append(compositor)
+                    frames_written += 1
+                    if "first_frame" not in timings:
+                        timings["first_frame"] = time.perf_counter() - start
+                    self.telemetry.sample("drawing", drawing_stats)
+
+                    if (
+                        frames_written % max_in_flight == 0
+                        or frames_written == num_frames
+                    ):
+                        self._progress("drawing", frames_written, num_frames)
+        except KeyboardInterrupt:
+            # Make the video out of the frames drawn so far
+            self._progress("interrupted", frames_written, num_frames)
+            self.telemetry.emit("interrupted", frames=frames_written)
+        except BrokenPipeError:
+            # Whoever was reading the stream is gone
+            self._progress("closed", frames_written, num_frames)
+            self.telemetry.emit("closed", frames=frames_written)
+        finally:
+            # Wait for frames that were still being drawn, their buffers are reused by the next render
+            for future, _ in in_flight:
+                future.cancel()
+            for future, _ in in_flight:
+                if not future.cancelled():
+                    future.exception()
+
+        self.telemetry.sample("drawing", drawing_stats, force=True)
+        end_stage("drawing")
+        timings["encoding"] = writer.encode_seconds
+        if frame_cache:
+            self._progress("frame_cache", frame_cache.hits, frames_written)
+
+        if encoder in VIDEO_FILE_ENCODERS:
+            start_stage("music")
+            self._progress("music")
+            music_file = music_future.result()
+            for resolution, video_file_path in video_file_paths.items():
+                video_file_paths[resolution] = finalize_video_with_music(
+                    writer,
+                    video_file_path,
+                    f"{output_path}{resolution_suffix(resolution, resolutions)}",
+                    music_file,
+                    theme.frame_rate,
+                    frames_written,
+                )
+            end_stage("music")
+
+        output_paths = {
+            f"{width}x{height}": path
+            for (width, height), path in video_file_paths.items()
+        }
+        return RenderResult(
+            video_file_paths[resolutions[0]], frames_written, timings, output_paths
+        )
+
+
+def echo_progress(stage, done, total):
+    """Report a Renderer's progress on stderr, like the command line always has"""
+    if stage == "notes":
+        click.echo("Processing MIDI notes...", err=True)
+    elif stage == "graph":
+        click.echo("Creating Graph...", err=True)
+    elif stage == "planning":
+        click.echo(
+            f"\rPlanning out frames... ({done} of {total} tracks)", nl=False, err=True
+        )
+    elif stage == "drawing":
+        if not done:
+            click.echo("\nDrawing frames, writing videos...", err=True)
+            return
+        of_total = f" of {total}" if total else ""
+        click.echo(f"\rProcessed {done}{of_total}...", nl=False, err=True)
+    elif stage == "interrupted":
+        click.echo(f"\nOk, let's just make the video now!", err=True)
+    elif stage == "closed":
+        click.echo(f"\nThe output stream was closed, stopping.", err=True)
+    elif stage == "frame_cache":
+        click.echo(f"\nLoaded {done} of {total} frames from the frame cache", err=True)
+    elif stage == "music":
+        click.echo("\nAdding the music...", err=True)
+    elif stage == "calibrating":
+        click.echo("\nDrawing sample frames to calibrate the cost model...", err=True)
+
+
+def generate_music_graph(
+    midi_file_path,
+    default_theme_file_path,
+    theme_file_path,
+    output_path,
+    soundfont_file,
+    encoder="ffmpeg",
+    codec=DEFAULT_CODEC,
+    preset=DEFAULT_PRESET,
+    crf=DEFAULT_CRF,
+    encoder_threads=0,
+    max_memory=None,
+    frame_cache_size=None,
+    resolutions=None,
+    telemetry=None,
+):
+    with Renderer(on_progress=echo_progress, telemetry=telemetry) as renderer:
+        result = renderer.render(
+            midi_file_path,
+            default_theme_file_path,
+            theme_file_path,
+            output_path,
+            soundfont_file,
+            encoder=encoder,
+            codec=codec,
+            preset=preset,
+            crf=crf,
+            encoder_threads=encoder_threads,
+            max_memory=max_memory,
+            frame_cache_size=frame_cache_size,
+            resolutions=resolutions,
+        )
+
+    drawing_seconds = result.timings.get("drawing", 0) - result.timings.get(
+        "encoding", 0
+    )
+    click.echo(
+        f"\nRendered {result.frames_written} frames at {result.frames_written / max(drawing_seconds, 1e-9):.1f} fps, "
+        f"encoded ({encoder}) at {result.frames_written / max(result.timings.get('encoding', 0), 1e-9):.1f} fps",
+        err=True,
     )
+    if "first_frame" in result.timings:
+        click.echo(f"First frame after {result.timings['first_frame']:.2f}s", err=True)
+    return result.output_path
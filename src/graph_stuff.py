@@ -1,14 +1,25 @@
 import re
 import math
-from collections import defaultdict, namedtuple
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from functools import lru_cache
 
-from PIL import Image, ImageDraw, ImageFilter, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
+from src.blur_stuff import blur_padding, gaussian_blur, quantize_blur_radius
 from src.theme_stuff import Theme
 from src.cache_stuff import get_cache_dir
+from src.frame_stuff import premultiply, scale_patch
 
 LINE_WIDTH = 3
 
+# Curves are drawn as polylines that stay within this many pixels of the true curve
+CURVE_TOLERANCE = 0.25
+
+# Blurred pulse masks kept for reuse, the largest ones are close to 1 MB each
+ELLIPSE_MASK_CACHE_BYTES = 64 * 1024**2
+
 Draw = namedtuple(
     "Draw",
     "pen_color fill_color p_points b_points e_points",
@@ -177,14 +188,52 @@ def hex_to_rgb(hex_color):
     return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
 
 
+def draw_node_shadows(offsets, image, shadows):
+    """
+    Draw the shadows of all nodes onto shared layers, one per blur radius, and blur each layer once.
+    `shadows` is a list of [e_points, node_shadow_color, node_shadow_size].
+    """
+    shadows_by_blur_radius = defaultdict(list)
+    for e_points, node_shadow_color, node_shadow_size in shadows:
+        if not node_shadow_color or not node_shadow_size:
+            continue
+        x0, y0, w, h = e_points
+
+        x0 += offsets[0]
+        y0 += offsets[1]
+
+        # Calculate the size increase based on the percentage
+        increase_w = w * node_shadow_size
+        increase_h = h * node_shadow_size
+        shadow_size = [
+            x0 - w - increase_w,
+            y0 - h - increase_h,
+            x0 + w + increase_w,
+            y0 + h + increase_h,
+        ]
+        blur_radius = int(max(increase_w, increase_h)) / 2  # Gaussian blur radius
+        shadows_by_blur_radius[blur_radius].append([shadow_size, node_shadow_color])
+
+    for blur_radius, shadow_sizes in shadows_by_blur_radius.items():
+        # Create a temporary image for the shadows
+        temp_image = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        temp_draw = ImageDraw.Draw(temp_image)
+
+        # Draw and blur the shadow ellipses
+        for shadow_size, node_shadow_color in shadow_sizes:
+            temp_draw.ellipse(shadow_size, fill=node_shadow_color)
+        temp_image = gaussian_blur(temp_image, blur_radius)
+
+        # Merge shadows with the main image
+        image.paste(temp_image, (0, 0), temp_image)
+
+
 def draw_ellipse(
     offsets,
     image,
     e_points,
     node_outline_color=None,
     node_fill_color=None,
-    node_shadow_color=None,
-    node_shadow_size=None,
     line_width=None,
 ):
     x0, y0, w, h = e_points
@@ -199,30 +248,6 @@ def draw_ellipse(
         y0 + h,
     ]
 
-    # Draw shadow if bg_fade and bg_fade_size are provided
-    if node_shadow_color and node_shadow_size:
-        # Calculate the size increase based on the percentage
-        increase_w = w * node_shadow_size
-        increase_h = h * node_shadow_size
-        shadow_size = [
-            x0 - w - increase_w,
-            y0 - h - increase_h,
-            x0 + w + increase_w,
-            y0 + h + increase_h,
-        ]
-
-        # Create a temporary image for the shadow
-        temp_image = Image.new("RGBA", image.size, (0, 0, 0, 0))
-        temp_draw = ImageDraw.Draw(temp_image)
-
-        # Draw and blur the shadow ellipse
-        temp_draw.ellipse(shadow_size, fill=node_shadow_color)
-        blur_radius = int(max(increase_w, increase_h)) / 2  # Gaussian blur radius
-        temp_image = temp_image.filter(ImageFilter.GaussianBlur(radius=blur_radius))
-
-        # Merge shadow with the main image
-        image.paste(temp_image, (0, 0), temp_image)
-
     draw = ImageDraw.Draw(image)
 
     # Draw the main ellipse
@@ -243,37 +268,50 @@ def bezier_point(t, points):
     return points[0]
 
 
-def draw_bezier_curve(offsets, image, points, pen_color, line_width, blur_radius):
-    # Create a transparent image to draw the curve
-    curve_image = Image.new("RGBA", image.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(curve_image)
+def bezier_curve(points, segments):
+    """Evaluate the Bézier curve defined by `points` at `segments + 1` evenly spaced values of t"""
+    n = len(points) - 1
+    t = np.linspace(0, 1, segments + 1)[:, None]
+    i = np.arange(n + 1)
+    coefficients = np.array([math.comb(n, k) for k in i])
+    basis = coefficients * (t**i) * ((1 - t) ** (n - i))
+    return [tuple(point) for point in (basis @ np.asarray(points, dtype=float))]
 
-    # Adjust points with offsets
-    points = [points[i : i + 2] for i in range(0, len(points), 2)]
-    points = [(c[0] + offsets[0], c[1] + offsets[1]) for c in points]
-
-    # Define the bezier curve function
-    def bezier_point(t, points):
-        n = len(points) - 1
-        return tuple(
-            sum(
-                c * (t**i) * ((1 - t) ** (n - i)) * math.comb(n, i)
-                for i, c in enumerate(coords)
-            )
-            for coords in zip(*points)
-        )
 
-    # Split the curve into segments and draw
-    segments = 500
-    curve = [bezier_point(t / segments, points) for t in range(segments + 1)]
-    for i in range(segments):
-        draw.line((curve[i], curve[i + 1]), fill=pen_color, width=line_width)
+def bezier_segments(points, tolerance=CURVE_TOLERANCE):
+    """
+    Number of evenly spaced segments needed for a polyline to stay within `tolerance` pixels of
+    the Bézier curve defined by `points` (Wang's formula), so short and flat curves get few segments.
+    """
+    n = len(points) - 1
+    if n < 2:
+        return 1
+    points = np.asarray(points, dtype=float)
+    second_differences = points[2:] - 2 * points[1:-1] + points[:-2]
+    largest = np.max(np.hypot(second_differences[:, 0], second_differences[:, 1]))
+    return max(1, math.ceil(math.sqrt(n * (n - 1) * largest / (8 * tolerance))))
+
+
+def draw_bezier_curves(offsets, image, curves, pen_color, line_width, blur_radius):
+    """Draw many curves as polylines onto one shared layer, blur it once, and composite it once"""
+    # Create a transparent image to draw the curves
+    curves_image = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(curves_image)
+
+    for points in curves:
+        # Adjust points with offsets
+        points = [points[i : i + 2] for i in range(0, len(points), 2)]
+        points = [(c[0] + offsets[0], c[1] + offsets[1]) for c in points]
+
+        # Split the curve into segments and draw them as a single polyline
+        curve = bezier_curve(points, bezier_segments(points))
+        draw.line(curve, fill=pen_color, width=line_width, joint="curve")
 
-    # Apply a blur filter to the curve image
-    curve_image = curve_image.filter(ImageFilter.GaussianBlur(blur_radius))
+    # Apply a blur filter to the curves image
+    curves_image = gaussian_blur(curves_image, blur_radius)
 
-    # Composite the blurred curve onto the original image
-    image.paste(curve_image, (0, 0), curve_image)
+    # Composite the blurred curves onto the original image
+    image.paste(curves_image, (0, 0), curves_image)
 
     return image
 
@@ -302,8 +340,41 @@ def calculate_alpha(frame_number, total_frames):
         )
 
 
+@lru_cache(maxsize=1024)
+def get_chord_line_sprite(points, line_width, color, border_color):
+    """
+    Render a chord line (border, blurred border, then the main line) at full opacity, cropped to its bounds.
+    Returns the sprite as a premultiplied RGBA array and the position of its top left corner.
+    """
+    blur_radius = 5
+    border_width = line_width * 2
+
+    curve = bezier_curve(points, bezier_segments(points))
+
+    padding = border_width + blur_radius * 3 + 2
+    left = math.floor(min(x for x, _ in curve)) - padding
+    top = math.floor(min(y for _, y in curve)) - padding
+    right = math.ceil(max(x for x, _ in curve)) + padding
+    bottom = math.ceil(max(y for _, y in curve)) + padding
+    curve = [(x - left, y - top) for x, y in curve]
+
+    sprite = Image.new("RGBA", (right - left, bottom - top), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(sprite)
+
+    # Draw the border/shadow
+    draw.line(
+        curve, fill=hex_to_rgba(border_color, 255), width=border_width, joint="curve"
+    )
+    sprite = gaussian_blur(sprite, blur_radius)
+    draw = ImageDraw.Draw(sprite)
+
+    # Draw the main line
+    draw.line(curve, fill=hex_to_rgba(color, 255), width=line_width, joint="curve")
+
+    return premultiply(np.asarray(sprite)), (left, top)
+
+
 def draw_fading_bezier_curve(
-    base_image,
     offsets,
     theme,
     points,
@@ -311,59 +382,50 @@ def draw_fading_bezier_curve(
     track,
     animation_len,
 ):
-    # Create a new transparent image to draw the Bézier curve
-    overlay_image = Image.new("RGBA", base_image.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(overlay_image)
-
     # Calculate alpha value for current frame
     alpha = calculate_alpha(frame_number, animation_len)
 
     # Split the points into pairs and apply offsets
     points = [points[i : i + 2] for i in range(0, len(points), 2)]
-    points = [(c[0] + offsets[0], c[1] + offsets[1]) for c in points]
+    points = tuple((c[0] + offsets[0], c[1] + offsets[1]) for c in points)
 
-    # Split the curve into segments
-    segments = 300 * len(points)
-    curve = [bezier_point(t / segments, points) for t in range(segments + 1)]
+    sprite, dest = get_chord_line_sprite(
+        points,
+        theme.chord_line_width(track),
+        theme.chord_line_color(track),
+        theme.chord_line_border_color(track),
+    )
 
-    # Draw the border/shadow
-    border_width = theme.chord_line_width(track) * 2
-    border_rgba_color = hex_to_rgba(theme.chord_line_border_color(track), alpha)
-    for i in range(segments):
-        draw.line(
-            (
-                curve[i],
-                curve[i + 1],
-            ),
-            fill=border_rgba_color,
-            width=border_width,
-        )
-    overlay_image = overlay_image.filter(ImageFilter.GaussianBlur(radius=5))
-    draw = ImageDraw.Draw(overlay_image)
-
-    # Convert hex color to RGBA with alpha for main line
-    rgba_color = hex_to_rgba(theme.chord_line_color(track), alpha)
-
-    # Draw the main line with fading effect
-    for i in range(segments):
-        draw.line(
-            (
-                curve[i],
-                curve[i + 1],
-            ),
-            fill=rgba_color,
-            width=theme.chord_line_width(track),
+    # Only the opacity changes from frame to frame, so just fade the cached sprite
+    return scale_patch(sprite, alpha), dest
+
+
+@lru_cache(maxsize=512)
+def get_ball_sprite(radius, color, stroke_color, stroke_width, blur_radius):
+    """
+    Render a ball once, padded so that its blur is not clipped.
+    Returns the sprite as a premultiplied RGBA array and the position of the ball's center within it.
+    """
+    padding = blur_padding(blur_radius)
+    center = radius + padding
+    sprite = Image.new("RGBA", (2 * center + 1, 2 * center + 1), color=None)
+    draw = ImageDraw.Draw(sprite)
+
+    # Draw the 3D-looking circle
+    for i in range(radius):
+        draw.ellipse(
+            [(center - i, center - i), (center + i, center + i)],
+            fill=color,
+            outline=hex_to_rgb(stroke_color),
+            width=stroke_width,
         )
 
-    # Composite the transparent overlay onto the base image
-    return Image.alpha_composite(
-        base_image.convert("RGBA"),
-        overlay_image,
-    )
+    sprite = gaussian_blur(sprite, blur_radius)
+
+    return premultiply(np.asarray(sprite)), center
 
 
 def animate_bezier_point(
-    base_image,
     offsets,
     theme,
     track,
@@ -371,51 +433,93 @@ def animate_bezier_point(
     frame_number,
     animation_length_in_frames,
 ):
-    overlay_image = Image.new(
-        "RGBA",
-        base_image.size,
-        color=None,
-    )
-    draw = ImageDraw.Draw(overlay_image)
-
     x_offset, y_offset = offsets
 
     t = frame_number / animation_length_in_frames
     point = bezier_point(t, [points[i : i + 2] for i in range(0, len(points), 2)])
     point_center = (x_offset + point[0], y_offset + point[1])
 
-    # Draw the 3D-looking circle
-    for i in range(theme.ball_radius(track) // 2):
-        # Calculate the color gradient based on the specified ball color
-        draw.ellipse(
-            [
-                (point_center[0] - i, point_center[1] - i),
-                (point_center[0] + i, point_center[1] + i),
-            ],
-            fill=theme.ball_color(track),
-            outline=hex_to_rgb(theme.ball_stroke_color(track)),
-            width=theme.ball_stroke_width(track),
-        )
-
+    blur_radius = 0
     blur_max = theme.ball_g_blur_max(track)
     if blur_max:
-        blur_radius = min(
-            animation_length_in_frames - frame_number,
-            theme.ball_g_blur_max(track) / (frame_number + 1),
-        )
-        overlay_image = overlay_image.filter(
-            ImageFilter.GaussianBlur(radius=blur_radius)
+        blur_radius = quantize_blur_radius(
+            min(
+                animation_length_in_frames - frame_number,
+                blur_max / (frame_number + 1),
+            ),
+            theme.blur_radius_resolution,
         )
 
-    # Composite the transparent overlay onto the base image
-    return Image.alpha_composite(
-        base_image.convert("RGBA"),
-        overlay_image,
+    sprite, center = get_ball_sprite(
+        theme.ball_radius(track) // 2,
+        theme.ball_color(track),
+        theme.ball_stroke_color(track),
+        theme.ball_stroke_width(track),
+        blur_radius,
     )
 
+    return sprite, (round(point_center[0]) - center, round(point_center[1]) - center)
+
+
+class EllipseMaskCache:
+    """
+    Blurred ellipse masks, shared by all the threads drawing frames.
+    The least recently used ones are dropped once they take up more than `max_bytes`,
+    which the renderer sets from its memory budget.
+    """
+
+    def __init__(self, max_bytes=ELLIPSE_MASK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._masks = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, size, bounding_box, blur_radius):
+        key = (size, bounding_box, blur_radius)
+        with self._lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+
+        mask = Image.new("L", size, 0)
+        ImageDraw.Draw(mask).ellipse(bounding_box, fill=255)
+        mask = np.asarray(gaussian_blur(mask, blur_radius))
+
+        with self._lock:
+            if key not in self._masks:
+                self._masks[key] = mask
+                self._total_bytes += mask.nbytes
+            self._trim()
+        return mask
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._trim()
+
+    def _trim(self):
+        while self._total_bytes > self.max_bytes and self._masks:
+            _, oldest = self._masks.popitem(last=False)
+            self._total_bytes -= oldest.nbytes
+
+
+ELLIPSE_MASKS = EllipseMaskCache()
+
+
+def get_blurred_ellipse_mask(size, bounding_box, blur_radius):
+    """
+    Blur a mask of an ellipse. The same note played again with the same velocity
+    hits the same node with the same radii, so most masks are blurred only once.
+    """
+    return ELLIPSE_MASKS.get(size, bounding_box, blur_radius)
+
 
 def animate_ellipsis_blur(
-    base_image,
     points,
     frame_number,
     offsets,
@@ -424,9 +528,6 @@ def animate_ellipsis_blur(
     animation_len,
     velocity,
 ):
-    image = base_image.copy()
-    draw = ImageDraw.Draw(image)
-
     x_offset, y_offset = offsets
     x0, y0, w, h = points
     x0 += x_offset
@@ -436,40 +537,67 @@ def animate_ellipsis_blur(
     w_increase = w * theme.note_increase_size(track) * (velocity / 127)
     h_increase = h * theme.note_increase_size(track) * (velocity / 127)
 
-    # Define the bounding box with the increased size
-    bounding_box = [
-        x0 - w - w_increase / 2,
-        y0 - h - h_increase / 2,
-        x0 + w + w_increase / 2,
-        y0 + h + h_increase / 2,
-    ]
-
-    # Draw the initial ellipse
-    draw.ellipse(
-        bounding_box,
-        outline=hex_to_rgb(theme.note_color(track)),
-        width=theme.note_stroke_width(track),
-    )
-
     # Determine the blur radius for this frame
     blur_strength = (frame_number / animation_len) * velocity
-    blur_radius = max(1, blur_strength)
+    blur_radius = quantize_blur_radius(
+        max(1, blur_strength), theme.blur_radius_resolution
+    )
 
-    # Create a mask for the ellipse to constrain the blur effect
-    mask = Image.new("L", image.size, 0)
-    mask_draw = ImageDraw.Draw(mask)
-    mask_draw.ellipse(bounding_box, fill=255)
+    # Only the area around the ellipse is affected, so work on that patch of the frame
+    padding = blur_padding(blur_radius)
+    left = max(0, math.floor(x0 - w - w_increase / 2) - padding)
+    top = max(0, math.floor(y0 - h - h_increase / 2) - padding)
+    right = min(theme.width, math.ceil(x0 + w + w_increase / 2) + padding)
+    bottom = min(theme.height, math.ceil(y0 + h + h_increase / 2) + padding)
+    if left >= right or top >= bottom:
+        return None
+
+    # Define the bounding box with the increased size
+    bounding_box = (
+        x0 - w - w_increase / 2 - left,
+        y0 - h - h_increase / 2 - top,
+        x0 + w + w_increase / 2 - left,
+        y0 + h + h_increase / 2 - top,
+    )
+    size = (right - left, bottom - top)
 
     # Apply the blur effect on the mask
-    mask_blurred = mask.filter(ImageFilter.GaussianBlur(blur_radius))
+    mask_blurred = get_blurred_ellipse_mask(size, bounding_box, blur_radius)
 
-    # Create a solid image for the blur color
-    ellipse = Image.new("RGBA", image.size, hex_to_rgb(theme.note_color(track)))
+    # The outline of the ellipse is drawn at full strength underneath the blurred ellipse
+    outline = Image.new("L", size, 0)
+    ImageDraw.Draw(outline).ellipse(
+        bounding_box,
+        outline=255,
+        width=theme.note_stroke_width(track),
+    )
+    alpha = np.maximum(mask_blurred, np.asarray(outline)).astype(np.uint16)
+
+    # Both are drawn in the note color, so the patch is that color, premultiplied by the combined mask
+    patch = np.empty((*alpha.shape, 4), dtype=np.uint8)
+    for channel, value in enumerate(hex_to_rgb(theme.note_color(track))):
+        patch[..., channel] = (alpha * value + 127) // 255
+    patch[..., 3] = alpha
+
+    return patch, (left, top)
+
+
+def layer_state(draw_function, kwargs):
+    """
+    Everything a layer's patch depends on, besides the theme and offsets.
+    Layers with the same state draw the same patch, e.g. a chord line on every frame it is fully opaque.
+    """
+    if draw_function is draw_fading_bezier_curve:
+        kwargs = dict(kwargs)
+        kwargs["frame_number"] = calculate_alpha(
+            kwargs["frame_number"], kwargs["animation_len"]
+        )
+    return draw_function.__qualname__, repr(sorted(kwargs.items()))
 
-    # Composite the blurred mask with the ellipse onto the base image
-    image.paste(ellipse, mask=mask_blurred)
 
-    return image
+@lru_cache(maxsize=16)
+def get_font(font_path, font_size):
+    return ImageFont.truetype(font_path, font_size)
 
 
 def draw_centered_text(
@@ -484,7 +612,7 @@ def draw_centered_text(
     outline_color,
     stroke_width,
 ):
-    font = ImageFont.truetype(font_path, font_size)
+    font = get_font(font_path, font_size)
     draw = ImageDraw.Draw(image)
     x += offsets[0]
     y += offsets[1]
@@ -544,6 +672,8 @@ def parse_graph(
     edges = defaultdict(dict)
 
     nodes_to_draw = []
+    shadows_to_draw = []
+    curves_to_draw = []
     text_to_draw = []
 
     for line in lines[1:-1]:
@@ -604,9 +734,14 @@ def parse_graph(
                         draw.e_points,
                         theme.node_outline_color,
                         theme.node_fill_color,
+                        theme.graph_line_width,
+                    ]
+                )
+                shadows_to_draw.append(
+                    [
+                        draw.e_points,
                         theme.node_shadow_color,
                         theme.node_shadow_size,
-                        theme.graph_line_width,
                     ]
                 )
                 nodes[line_id] = draw
@@ -616,14 +751,7 @@ def parse_graph(
                 edges[a][b] = draw
                 edges[b][a] = draw
                 if theme.show_lines:
-                    draw_bezier_curve(
-                        offsets,
-                        graph_image,
-                        draw.b_points,
-                        theme.graph_line_color,
-                        theme.graph_line_width,
-                        theme.graph_line_blur,
-                    )
+                    curves_to_draw.append(draw.b_points)
 
         if "_ldraw_" in attrs_dict and not theme.hide_letters:
             ldraw = parse_ldraw(attrs_dict["_ldraw_"], theme.dpi)
@@ -648,6 +776,18 @@ def parse_graph(
                 ]
             )
 
+    if curves_to_draw:
+        draw_bezier_curves(
+            offsets,
+            graph_image,
+            curves_to_draw,
+            theme.graph_line_color,
+            theme.graph_line_width,
+            theme.graph_line_blur,
+        )
+
+    draw_node_shadows(offsets, graph_image, shadows_to_draw)
+
     for args in nodes_to_draw:
         draw_ellipse(offsets, graph_image, *args)
 
@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+from src.frame_stuff import composite_patches
+from src.graph_stuff import layer_state
+
+# Room for the groups of the last few frames of every track, they are often full frame sized
+LAYER_GROUP_CACHE_BYTES = 256 * 1024**2
+
+# States remembered as drawn once, a group is built the second time one is seen.
+# Older ones are forgotten, a state that comes back much later is just drawn once more before being grouped
+MAX_SEEN_STATES = 65536
+
+
+class LayerGroups:
+    """
+    Draws each track's layers as one group, composited on top of the tracks before it.
+    A track's group is kept and reused on every frame where its layers are in the same state,
+    e.g. a held chord on one track while another track moves, so only the tracks that change get drawn.
+    Groups are shared by all the threads drawing frames, the least recently used ones are dropped
+    once they take up more than `max_bytes`.
+    """
+
+    def __init__(self, theme, offsets, max_bytes=LAYER_GROUP_CACHE_BYTES):
+        self.theme = theme
+        self.offsets = offsets
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._groups = OrderedDict()
+        # Hashes of the states that were drawn once, least recently seen first
+        self._seen = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def draw(self, draw_list, compositor):
+        """Blend the [draw_function, {kwargs}] pairs of a frame onto the compositor, one track at a time"""
+        layers_by_track = {}
+        for draw_function, kwargs in draw_list:
+            layers_by_track.setdefault(kwargs.get("track"), []).append(
+                (draw_function, kwargs)
+            )
+        for track in sorted(layers_by_track, key=str):
+            layers = layers_by_track[track]
+            key = tuple(
+                layer_state(draw_function, kwargs) for draw_function, kwargs in layers
+            )
+            with self._lock:
+                group = self._groups.get(key)
+                if group is not None:
+                    self._groups.move_to_end(key)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    # Most states are never seen again, only pay for a group the second time around
+                    seen = hash(key) in self._seen
+                    self._seen[hash(key)] = None
+                    self._seen.move_to_end(hash(key))
+                    if len(self._seen) > MAX_SEEN_STATES:
+                        self._seen.popitem(last=False)
+
+            if group is None:
+                patches = self._draw_layers(layers)
+                if not seen:
+                    for patch in patches:
+                        compositor.blend(*patch)
+                    continue
+                group = self._store(key, patches)
+            if group[0] is not None:
+                compositor.blend(*group)
+
+    def _draw_layers(self, layers):
+        patches = []
+        for draw_function, kwargs in layers:
+            patch = draw_function(theme=self.theme, offsets=self.offsets, **kwargs)
+            if patch:
+                patches.append(patch)
+        return patches
+
+    def _store(self, key, patches):
+        group = composite_patches(patches) if patches else (None, None)
+        with self._lock:
+            if key not in self._groups:
+                self._groups[key] = group
+                self._total_bytes += self._size(group)
+            while self._total_bytes > self.max_bytes and len(self._groups) > 1:
+                _, oldest = self._groups.popitem(last=False)
+                self._total_bytes -= self._size(oldest)
+        return group
+
+    @staticmethod
+    def _size(group):
+        patch, _ = group
+        return 0 if patch is None else patch.nbytes
@@ -0,0 +1,244 @@
+import json
+import queue
+import socket
+import threading
+import time
+from collections import namedtuple
+
+import click
+import numpy as np
+
+from src.animation_stuff import FRAMES_PER_BUCKET, AnimationFrames
+from src.frame_stuff import FrameCompositor, premultiply
+from src.generate_music_graph import (
+    create_graphviz_sorted,
+    plan_balls,
+    plan_chord_lines,
+    plan_pulses,
+    process_frame,
+)
+from src.graph_stuff import parse_graph
+from src.midi_stuff import get_note
+from src.smf_stuff import read_midi_notes
+
+# A played note, `time` is in seconds since the stream started, None means "when it arrives"
+NoteEvent = namedtuple("NoteEvent", "pitch velocity time", defaults=(None,))
+
+# Live notes are all drawn on one track, the one every note gets with squash_tracks
+LIVE_TRACK = "track_2"
+LIVE_TRACK_NUMBER = 0
+
+# Node numbers (pitch class + 1), starting from F
+CIRCLE_OF_FIFTHS = [6, 1, 8, 3, 10, 5, 12, 7, 2, 9, 4, 11]
+
+DEFAULT_LATENCY = 0.1
+DEFAULT_PORT = 9000
+
+# How long pulses and balls last, since the length of a live note isn't known when it starts
+LIVE_NOTE_SECONDS = 0.5
+LIVE_BALL_SECONDS = 0.25
+
+
+def create_live_layout(theme):
+    """
+    Lay out all 12 pitch classes ahead of time, in the theme's order or else the circle of fifths.
+    Any note can follow any other, so every pair of nodes gets an edge.
+    """
+    order = CIRCLE_OF_FIFTHS
+    if isinstance(theme.nodes_sorted, list):
+        order = theme.nodes_sorted
+    nodes = [get_note(LIVE_TRACK_NUMBER, number - 1) for number in order]
+    edge_weights = {(a, b): 1 for i, a in enumerate(nodes) for b in nodes[i + 1 :]}
+    # Pin the nodes around the circle in this order, whatever the theme's engine and sorting
+    graph = create_graphviz_sorted(theme, nodes, nodes, edge_weights, order=order)
+    return parse_graph(graph, theme)
+
+
+class LiveRenderer:
+    """
+    Draws frames from a live stream of notes, on a layout that is fixed ahead of time.
+    A frame is drawn `latency` seconds after it is due, so notes that arrive a little late still make it.
+    Frames that can't be drawn in time are skipped to keep up with real time,
+    and the last frame drawn is sent again in their place, so the stream keeps its frame rate.
+    """
+
+    def __init__(self, theme, latency=DEFAULT_LATENCY):
+        self.theme = theme
+        self.latency = latency
+        base_image, self.nodes, self.edges, self.offsets = create_live_layout(theme)
+        self.size = base_image.size
+        self.compositor = FrameCompositor(
+            premultiply(np.asarray(base_image.convert("RGBA")))
+        )
+        self.frames = AnimationFrames()
+        self.frames_drawn = 0
+        self.frames_skipped = 0
+        self.note_frames = theme.note_num_frames(LIVE_TRACK) or round(
+            LIVE_NOTE_SECONDS * theme.frame_rate
+        )
+        self.ball_frames = max(1, round(LIVE_BALL_SECONDS * theme.frame_rate))
+        self._pending = []
+        self._prev_notes = None
+        # Animations are forgotten a bucket at a time, once the frames get past it
+        self._next_drop_frame = FRAMES_PER_BUCKET
+
+    def add_note(self, event, now):
+        """Queue a note to be drawn, `now` is the stream time it arrived at"""
+        if not event.velocity:
+            # Note offs, pulses have a fixed length
+            return
+        note_time = now if event.time is None else event.time
+        self._pending.append(
+            (round(note_time * self.theme.frame_rate), event.pitch, event.velocity)
+        )
+
+    def _plan_until(self, frame_index):
+        """Plan the notes due by `frame_index` as one chord, notes that came in too late are drawn now"""
+        due = [note for note in self._pending if note[0] <= frame_index]
+        if not due:
+            return
+        self._pending = [note for note in self._pending if note[0] > frame_index]
+
+        velocities = {}
+        for _, pitch, velocity in due:
+            note = get_note(LIVE_TRACK_NUMBER, pitch)
+            velocities[note] = max(velocity, velocities.get(note, 0))
+        note_tuples = [
+            (note, velocity, self.note_frames) for note, velocity in velocities.items()
+        ]
+        curr_notes = list(velocities)
+
+        plan_pulses(self.frames, LIVE_TRACK, self.nodes, frame_index, note_tuples)
+        if not self.theme.pulses_only(LIVE_TRACK):
+            plan_chord_lines(
+                self.frames,
+                self.theme,
+                LIVE_TRACK,
+                self.edges,
+                frame_index,
+                note_tuples,
+            )
+            if self._prev_notes:
+                # The balls leave when the next chord is played, there's no looking ahead
+                plan_balls(
+                    self.frames,
+                    self.theme,
+                    LIVE_TRACK,
+                    self.edges,
+                    self._prev_notes,
+                    curr_notes,
+                    frame_index,
+                    self.ball_frames,
+                )
+        self._prev_notes = curr_notes
+
+    def draw_frame(self, frame_index):
+        """Draw a frame, it is only valid until the next one is drawn"""
+        self._plan_until(frame_index)
+        frame = process_frame(
+            frame_index, self.compositor, self.theme, self.offsets, self.frames
+        )
+        if frame_index >= self._next_drop_frame:
+            # Skipped frames can jump past the start of a bucket
+            bucket_start = frame_index - frame_index % FRAMES_PER_BUCKET
+            self.frames.drop_frames_before(bucket_start)
+            self._next_drop_frame = bucket_start + FRAMES_PER_BUCKET
+        self.frames_drawn += 1
+        return frame
+
+    def run(self, events, on_frame, clock=time.perf_counter):
+        """
+        Draw frames in real time until `events` runs out and the last animations are done.
+        `events` is any iterable of NoteEvents, it is read in a background thread.
+        `on_frame(frame_index, frame)` must be done with the frame before it returns.
+        """
+        incoming = queue.Queue()
+
+        def read_events():
+            try:
+                for event in events:
+                    incoming.put(event)
+            finally:
+                incoming.put(None)
+
+        threading.Thread(target=read_events, daemon=True).start()
+
+        frame_rate = self.theme.frame_rate
+        finished = False
+        frame_index = 0
+        # Until the first frame is drawn, the base frame stands in for skipped ones
+        self.compositor.reset()
+        frame = self.compositor.frame
+        start = clock()
+        while True:
+            deadline = start + frame_index / frame_rate + self.latency
+            # Collect notes until the frame is due
+            while not finished:
+                try:
+                    event = incoming.get(timeout=max(0, deadline - clock()))
+                except queue.Empty:
+                    break
+                if event is None:
+                    finished = True
+                else:
+                    self.add_note(event, clock() - start)
+            if finished:
+                if not self._pending and frame_index >= len(self.frames):
+                    break
+                time.sleep(max(0, deadline - clock()))
+
+            late_frames = int((clock() - deadline) * frame_rate)
+            for _ in range(max(0, late_frames)):
+                on_frame(frame_index, frame)
+                frame_index += 1
+                self.frames_skipped += 1
+
+            frame = self.draw_frame(frame_index)
+            on_frame(frame_index, frame)
+            frame_index += 1
+
+
+def socket_note_events(host="127.0.0.1", port=DEFAULT_PORT):
+    """
+    Wait for one connection, and read notes from it as JSON lines,
+    e.g. {"pitch": 60, "velocity": 100} or with a "time" in seconds.
+    """
+    with socket.create_server((host, port)) as server:
+        connection, _ = server.accept()
+        with connection, connection.makefile("r") as lines:
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                    note_time = message.get("time")
+                    event = NoteEvent(
+                        int(message["pitch"]),
+                        int(message.get("velocity", 100)),
+                        None if note_time is None else float(note_time),
+                    )
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    # One bad message shouldn't end the performance
+                    click.echo(f"Skipping malformed note: {line.strip()}", err=True)
+                    continue
+                yield event
+
+
+def replay_midi_file(midi_file_path, speed=1.0):
+    """Play the notes of a MIDI file in real time, as if they came from a live performance"""
+    instruments = read_midi_notes(midi_file_path)
+    if not instruments:
+        return
+    starts = np.concatenate([starts for starts, _, _, _ in instruments]) / speed
+    pitches = np.concatenate([pitches for _, _, pitches, _ in instruments])
+    velocities = np.concatenate([velocities for _, _, _, velocities in instruments])
+    order = np.argsort(starts, kind="stable")
+
+    start = time.perf_counter()
+    for note_time, pitch, velocity in zip(
+        starts[order].tolist(), pitches[order].tolist(), velocities[order].tolist()
+    ):
+        delay = start + note_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield NoteEvent(pitch, velocity, note_time)
@@ -0,0 +1,80 @@
+import re
+import time
+
+MEMORY_UNITS = {
+    "": 1,
+    "K": 1024,
+    "M": 1024**2,
+    "G": 1024**3,
+    "T": 1024**4,
+}
+
+# Rough size of one planned animation, its descriptor, kwargs and references from the frame buckets
+PLAN_BYTES_PER_ANIMATION = 1024
+
+# Each frame in flight needs its buffer, plus temporaries while it is drawn and encoded
+BYTES_PER_FRAME_IN_FLIGHT_FACTOR = 2
+
+# The budget is checked before every frame, but memory use only needs to be read this often
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def parse_memory_size(value):
+    """Parse sizes like "512M", "4G" or "1073741824" into a number of bytes"""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)I?B?\s*", str(value).upper())
+    if not match:
+        raise ValueError(f"Invalid memory size: {value}")
+    number, unit = match.groups()
+    return int(float(number) * MEMORY_UNITS[unit])
+
+
+def get_rss():
+    import psutil
+
+    return psutil.Process().memory_info().rss
+
+
+class MemoryBudget:
+    """
+    Splits a `--max_memory` budget between the frame plan, the frames in flight and the drawing caches.
+    With no budget, nothing is limited beyond the defaults.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._rss = 0
+        self._next_rss_sample = 0.0
+
+    def max_frames_in_flight(self, frame_bytes, default):
+        if not self.max_bytes:
+            return default
+        # Half of the budget goes to frames, the rest is left for the plan, caches and the interpreter
+        frames_budget = self.max_bytes // 2
+        per_frame = frame_bytes * BYTES_PER_FRAME_IN_FLIGHT_FACTOR
+        return max(1, min(default, frames_budget // per_frame))
+
+    def layer_group_bytes(self, default):
+        if not self.max_bytes:
+            return default
+        # Frames take half of the budget and the plan up to a quarter, groups get a share of what's left
+        return min(default, self.max_bytes // 8)
+
+    def ellipse_mask_bytes(self, default):
+        if not self.max_bytes:
+            return default
+        # Layer groups get an eighth of the budget, the pulse masks half as much
+        return min(default, self.max_bytes // 16)
+
+    def should_spill_plan(self, plan):
+        if not self.max_bytes:
+            return False
+        return plan.estimated_size > self.max_bytes // 4
+
+    def over_budget(self):
+        if not self.max_bytes:
+            return False
+        now = time.monotonic()
+        if now >= self._next_rss_sample:
+            self._rss = get_rss()
+            self._next_rss_sample = now + RSS_SAMPLE_SECONDS
+        return self._rss > self.max_bytes
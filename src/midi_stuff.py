@@ -1,20 +1,20 @@
-import pretty_midi
-from midi2audio import FluidSynth
-from collections import defaultdict
-import click
+import numpy as np
 import hashlib
-from src.cache_stuff import get_music_cache_dir
-import pickle
+import json
+from src.cache_stuff import atomic_write_path, get_music_cache_dir
+from src.smf_stuff import read_midi_notes
 import os
 
-# https://schristiancollins.com/generaluser.php
-SOUND_FONT_FILE = "assets/GeneralUser GS 1.471/GeneralUser GS v1.471.sf2"
-
 TRACK_NOTE_DELIMITER = "#"
 
+# Bump this whenever NOTE_DTYPE, or the way notes are read, changes
+NOTE_CACHE_VERSION = 2
+
 
-def convert_midi_to_wav(midi_file_path, wav_file_path, soundfont):
-    fs = FluidSynth(soundfont)
+def convert_midi_to_wav(midi_file_path, wav_file_path, soundfont, sample_rate=44100):
+    from midi2audio import FluidSynth
+
+    fs = FluidSynth(soundfont, sample_rate=sample_rate)
     fs.midi_to_audio(midi_file_path, wav_file_path)
 
 
@@ -26,16 +26,153 @@ def get_note(track, number):
     return f"{track}{TRACK_NOTE_DELIMITER}{(number % 12) + 1}"
 
 
-def _get_pickle_filename(fps, squash_tracks, group_notes_by_track):
-    params_str = f"{fps}_{squash_tracks}_{group_notes_by_track}"
-    params_hash = hashlib.md5(params_str.encode()).hexdigest()
-    return f"note_frames_{params_hash}.pkl"
+# One row per note, a few bytes each
+NOTE_DTYPE = np.dtype(
+    [
+        ("track", np.int16),  # Track number used in the node keys, see `get_note`
+        ("onset_frame", np.int32),
+        ("length_frames", np.int32),
+        ("pitch_class", np.int8),  # 0 = C, 1 = C#, ...
+        ("velocity", np.uint8),
+    ]
+)
+
 
+class NoteStore:
+    """
+    Columnar storage for the notes of a song.
+    Each track is a NumPy structured array of NOTE_DTYPE, sorted by onset frame.
+    Chords (the notes starting on the same frame) are views into those arrays.
+    """
 
-def defaultdict_to_dict(d):
-    if isinstance(d, defaultdict):
-        d = {k: defaultdict_to_dict(v) for k, v in d.items()}
-    return d
+    def __init__(self, tracks):
+        self._tracks = tracks
+        self._node_keys = {}
+
+    @property
+    def tracks(self):
+        return list(self._tracks.keys())
+
+    def __len__(self):
+        return sum(len(notes) for notes in self._tracks.values())
+
+    def notes(self, track):
+        return self._tracks[track]
+
+    def chords(self, track):
+        """Return a list of (onset_frame, notes) pairs, where `notes` is a view of the notes starting on that frame"""
+        notes = self._tracks[track]
+        if not len(notes):
+            return []
+        onsets = notes["onset_frame"]
+        boundaries = np.flatnonzero(np.diff(onsets)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(notes)]))
+        return [
+            (int(onsets[start]), notes[start:end]) for start, end in zip(starts, ends)
+        ]
+
+    def node_keys(self, notes):
+        """Return the graph node key of each note in `notes`"""
+        keys = []
+        for track, pitch_class in zip(
+            notes["track"].tolist(), notes["pitch_class"].tolist()
+        ):
+            key = self._node_keys.get((track, pitch_class))
+            if key is None:
+                key = self._node_keys[(track, pitch_class)] = get_note(
+                    track, pitch_class
+                )
+            keys.append(key)
+        return keys
+
+    def save(self, path):
+        """
+        Save as `<path>.npy`, all tracks in one array, and `<path>.json`, which says where each track is.
+        The index is written last, so a store is only visible once it is complete.
+        """
+        tracks = []
+        offset = 0
+        for track, notes in self._tracks.items():
+            tracks.append([track, offset, offset + len(notes)])
+            offset += len(notes)
+        all_notes = np.concatenate(
+            list(self._tracks.values()) or [np.empty(0, NOTE_DTYPE)]
+        )
+
+        with atomic_write_path(f"{path}.npy") as temp_path:
+            with open(temp_path, "wb") as f:
+                np.save(f, all_notes, allow_pickle=False)
+        with atomic_write_path(f"{path}.json") as temp_path:
+            with open(temp_path, "w") as f:
+                json.dump({"version": NOTE_CACHE_VERSION, "tracks": tracks}, f)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a store written by `save`, returns None if there isn't a compatible one"""
+        try:
+            with open(f"{path}.json") as f:
+                index = json.load(f)
+            if index["version"] != NOTE_CACHE_VERSION:
+                return None
+            all_notes = np.load(f"{path}.npy", mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError, KeyError):
+            return None
+        if all_notes.dtype != NOTE_DTYPE:
+            return None
+        return cls(
+            {track: all_notes[start:end] for track, start, end in index["tracks"]}
+        )
+
+
+def build_note_store(
+    instruments,
+    fps,
+    squash_tracks=False,
+    group_notes_by_track=False,
+):
+    """
+    Build a NoteStore from a list of (starts, ends, pitches, velocities) arrays, one per instrument.
+    Times are in seconds, and are quantized to frames all at once.
+    """
+    track_names = []
+    notes = []
+    for i, (starts, ends, pitches, velocities) in enumerate(instruments, start=1):
+        if not len(starts):
+            continue
+        track_number = 0
+        if group_notes_by_track:
+            track_number = i + 1
+        track_name = "track_2" if squash_tracks else f"track_{track_number}"
+
+        starts = np.asarray(starts, dtype=np.float64)
+        ends = np.asarray(ends, dtype=np.float64)
+        instrument_notes = np.empty(len(starts), dtype=NOTE_DTYPE)
+        instrument_notes["track"] = track_number
+        instrument_notes["onset_frame"] = (starts * fps).astype(np.int64)
+        instrument_notes["length_frames"] = ((ends - starts) * fps).astype(np.int64)
+        instrument_notes["pitch_class"] = np.asarray(pitches) % 12
+        instrument_notes["velocity"] = velocities
+
+        track_names.append(track_name)
+        notes.append(instrument_notes)
+
+    tracks = {}
+    for track_name in dict.fromkeys(track_names):
+        track_notes = np.concatenate(
+            [n for name, n in zip(track_names, notes) if name == track_name]
+        )
+        # A stable sort keeps notes that start together in instrument order
+        order = np.argsort(track_notes["onset_frame"], kind="stable")
+        tracks[track_name] = track_notes[order]
+
+    return NoteStore(tracks)
+
+
+def _get_note_cache_filename(fps, squash_tracks, group_notes_by_track):
+    params_str = f"{fps}_{squash_tracks}_{group_notes_by_track}"
+    params_hash = hashlib.md5(params_str.encode()).hexdigest()
+    return f"notes_v{NOTE_CACHE_VERSION}_{params_hash}"
 
 
 def get_note_start_times_in_frames(
@@ -45,45 +182,18 @@ def get_note_start_times_in_frames(
         group_notes_by_track=False,
 ):
     cache_dir = get_music_cache_dir(midi_file_path)
-    pickle_filename = _get_pickle_filename(fps, squash_tracks, group_notes_by_track)
-    pickle_path = os.path.join(cache_dir, pickle_filename)
-    if os.path.exists(pickle_path):
-        click.echo("Loading cached note frames...")
-        with open(pickle_path, 'rb') as f:
-            click.echo("Done...")
-            return pickle.load(f)
-
-    click.echo("Processing MIDI notes...")
-    # Load the MIDI file
-    midi_data = pretty_midi.PrettyMIDI(midi_file_path)
-
-    track_events_frames = defaultdict(lambda: defaultdict(list))
-
-    for i, instrument in enumerate(midi_data.instruments, start=1):
-        for note in instrument.notes:
-            # Calculate the start time of the note in seconds and convert to frames
-            start_time = note.start
-            end_time = note.end
-            frame = int(start_time * fps)
-            note_length_in_frames = int((end_time - start_time) * fps)
-
-            track_name = 0
-            if group_notes_by_track:
-                track_name = i + 1
-            note_value = get_note(track_name, note.pitch)
-
-            note_tuple = (
-                note_value,
-                note.velocity,
-                note_length_in_frames,
-            )
-            if squash_tracks:
-                track_events_frames[f"track_2"][frame].append(note_tuple)
-            else:
-                track_events_frames[f"track_{track_name}"][frame].append(note_tuple)
-
-    results = defaultdict_to_dict(track_events_frames)
-    with open(pickle_path, 'wb') as f:
-        pickle.dump(results, f)
+    cache_filename = _get_note_cache_filename(fps, squash_tracks, group_notes_by_track)
+    cache_path = os.path.join(cache_dir, cache_filename)
+    note_store = NoteStore.load(cache_path)
+    if note_store is not None:
+        return note_store
+
+    results = build_note_store(
+        read_midi_notes(midi_file_path),
+        fps,
+        squash_tracks=squash_tracks,
+        group_notes_by_track=group_notes_by_track,
+    )
+    results.save(cache_path)
 
     return results
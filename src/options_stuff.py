@@ -0,0 +1,63 @@
+# Command line choices and defaults, shared by the CLIs, the render service and the renderer.
+# Nothing heavy is imported here, so that --help and argument errors come back right away
+
+# https://schristiancollins.com/generaluser.php
+SOUND_FONT_FILE = "assets/GeneralUser GS 1.471/GeneralUser GS v1.471.sf2"
+
+ENCODERS = ["ffmpeg", "y4m", "rgb", "rgba", "png", "qoi"]
+
+# Encoders that produce a video file that music can be added to
+VIDEO_FILE_ENCODERS = ["ffmpeg"]
+
+# Encoders that write frames to stdout as soon as they are drawn, e.g. for a live preview
+STREAM_ENCODERS = ["y4m", "rgb", "rgba"]
+
+DEFAULT_CODEC = "libx264"
+DEFAULT_PRESET = "medium"
+DEFAULT_CRF = 23
+
+# Pixels a scaled down side may be off by, from rounding
+ASPECT_RATIO_TOLERANCE = 2
+
+
+def parse_resolution(value):
+    """Parse a resolution like "540x960" into (width, height)"""
+    try:
+        width, height = (int(n) for n in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Expected a resolution like 540x960, got {value!r}")
+    if width <= 0 or height <= 0:
+        raise ValueError(f"Resolution must be positive, got {value!r}")
+    return width, height
+
+
+def check_resolutions(resolutions, size, encoder=None):
+    """
+    The output resolutions for frames drawn at `size`, largest first, without duplicates.
+    Outputs are scaled down from the drawn frames, so none can be larger, and keep their aspect ratio:
+    a resolution may only be off by the rounding of its sides, up to `ASPECT_RATIO_TOLERANCE` pixels,
+    e.g. to make them even for video codecs.
+    Video files are encoded as YUV 4:2:0, which needs the sides of every resolution to be even.
+    """
+    resolutions = sorted(
+        {tuple(resolution) for resolution in resolutions},
+        key=lambda resolution: resolution[0] * resolution[1],
+        reverse=True,
+    )
+    for width, height in resolutions:
+        if encoder in VIDEO_FILE_ENCODERS and (width % 2 or height % 2):
+            raise ValueError(
+                f"Resolution {width}x{height} has an odd side, the {encoder} encoder needs even ones"
+            )
+        if width > size[0] or height > size[1]:
+            raise ValueError(
+                f"Resolution {width}x{height} is larger than the theme's {size[0]}x{size[1]}"
+            )
+        if (
+            abs(width * size[1] / size[0] - height) > ASPECT_RATIO_TOLERANCE
+            and abs(height * size[0] / size[1] - width) > ASPECT_RATIO_TOLERANCE
+        ):
+            raise ValueError(
+                f"Resolution {width}x{height} doesn't have the aspect ratio of the theme's {size[0]}x{size[1]}"
+            )
+    return resolutions
@@ -0,0 +1,182 @@
+import numpy as np
+
+DEFAULT_TEMPO = 500000  # Microseconds per beat, 120 BPM
+
+
+class MidiFileError(ValueError):
+    pass
+
+
+def _read_variable_length(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def _read_track(data, pos, end, track_index, instruments, tempos):
+    """Read the note and tempo events of one MTrk chunk"""
+    tick = 0
+    running_status = None
+    programs = [0] * 16
+    # (channel, pitch) -> list of (start tick, velocity)
+    open_notes = {}
+
+    while pos < end:
+        delta, pos = _read_variable_length(data, pos)
+        tick += delta
+
+        status = data[pos]
+        if status < 0x80:
+            if running_status is None:
+                raise MidiFileError(f"Running status without a status byte at {pos}")
+            status = running_status
+        else:
+            pos += 1
+
+        if status == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_variable_length(data, pos + 1)
+            # Like pretty_midi, only the first track's tempo events count,
+            # that's where type 0 and type 1 files keep them
+            if meta_type == 0x51 and length == 3 and track_index == 0:
+                tempos.append((tick, int.from_bytes(data[pos : pos + 3], "big")))
+            elif meta_type == 0x2F:
+                break
+            pos += length
+            continue
+
+        if status == 0xF0 or status == 0xF7:
+            length, pos = _read_variable_length(data, pos)
+            pos += length
+            continue
+
+        running_status = status
+        kind = status & 0xF0
+        channel = status & 0x0F
+
+        if kind == 0xC0:
+            programs[channel] = data[pos]
+            pos += 1
+            continue
+        if kind == 0xD0:
+            pos += 1
+            continue
+
+        pitch = data[pos]
+        velocity = data[pos + 1]
+        pos += 2
+
+        if kind == 0x90 and velocity > 0:
+            open_notes.setdefault((channel, pitch), []).append((tick, velocity))
+        elif kind == 0x80 or kind == 0x90:
+            key = (channel, pitch)
+            notes = open_notes.get(key)
+            if notes is None:
+                # Spurious note off
+                continue
+
+            # One note off closes every note on this channel and pitch from earlier ticks,
+            # a note on from this very tick keeps playing
+            notes_to_keep = []
+            for start_tick, note_velocity in notes:
+                if start_tick == tick:
+                    notes_to_keep.append((start_tick, note_velocity))
+                    continue
+                instrument_key = (programs[channel], channel, track_index)
+                instrument = instruments.get(instrument_key)
+                if instrument is None:
+                    instrument = instruments[instrument_key] = ([], [], [], [])
+                instrument[0].append(start_tick)
+                instrument[1].append(tick)
+                instrument[2].append(pitch)
+                instrument[3].append(note_velocity)
+
+            if notes_to_keep and len(notes_to_keep) < len(notes):
+                open_notes[key] = notes_to_keep
+            else:
+                del open_notes[key]
+
+
+def _ticks_to_seconds(ticks, ticks_per_beat, tempos):
+    """Convert absolute ticks to seconds, using the tempo changes of the first track"""
+    tick_scales = [(0, DEFAULT_TEMPO / 1e6 / ticks_per_beat)]
+    for tick, tempo in sorted(tempos, key=lambda t: t[0]):
+        tick_scale = tempo / 1e6 / ticks_per_beat
+        if tick == 0:
+            tick_scales = [(0, tick_scale)]
+        elif tick_scale != tick_scales[-1][1]:
+            tick_scales.append((tick, tick_scale))
+
+    scale_ticks = np.array([tick for tick, _ in tick_scales], dtype=np.int64)
+    scales = np.array([scale for _, scale in tick_scales])
+    # The time at which each tempo starts
+    scale_times = np.concatenate(([0.0], np.cumsum(np.diff(scale_ticks) * scales[:-1])))
+
+    ticks = np.asarray(ticks, dtype=np.int64)
+    interval = np.searchsorted(scale_ticks, ticks, side="right") - 1
+    return scale_times[interval] + (ticks - scale_ticks[interval]) * scales[interval]
+
+
+def read_midi_notes(midi_file_path):
+    """
+    Return the notes of a MIDI file as a list of (starts, ends, pitches, velocities) arrays, one per instrument.
+    Starts and ends are in seconds.
+    Only note and tempo events are read, no objects are created per event.
+    Notes are grouped into instruments the same way pretty_midi does it (by track, channel and program,
+    in the order their first note ends), so track numbers in themes keep pointing at the same instruments.
+    """
+    with open(midi_file_path, "rb") as f:
+        data = f.read()
+
+    if data[:4] != b"MThd":
+        raise MidiFileError(f"{midi_file_path} is not a MIDI file")
+    header_length = int.from_bytes(data[4:8], "big")
+    division = int.from_bytes(data[12:14], "big")
+
+    instruments = {}
+    tempos = []
+    pos = 8 + header_length
+    track_index = 0
+    while pos + 8 <= len(data):
+        chunk_type = data[pos : pos + 4]
+        chunk_length = int.from_bytes(data[pos + 4 : pos + 8], "big")
+        chunk_start = pos + 8
+        chunk_end = min(chunk_start + chunk_length, len(data))
+        if chunk_type == b"MTrk":
+            try:
+                _read_track(
+                    data, chunk_start, chunk_end, track_index, instruments, tempos
+                )
+            except IndexError:
+                raise MidiFileError(
+                    f"Track {track_index} of {midi_file_path} is truncated"
+                )
+            track_index += 1
+        pos = chunk_end
+
+    if division & 0x8000:
+        # SMPTE timing, a fixed number of ticks per second, tempo changes don't apply
+        frames_per_second = 256 - (division >> 8)
+        seconds_per_tick = 1 / (frames_per_second * (division & 0xFF))
+
+        def to_seconds(ticks):
+            return np.asarray(ticks, dtype=np.float64) * seconds_per_tick
+
+    else:
+
+        def to_seconds(ticks):
+            return _ticks_to_seconds(ticks, division, tempos)
+
+    return [
+        (
+            to_seconds(starts),
+            to_seconds(ends),
+            np.array(pitches, dtype=np.int16),
+            np.array(velocities, dtype=np.uint8),
+        )
+        for starts, ends, pitches, velocities in instruments.values()
+    ]
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+
+from src.memory_stuff import get_rss
+
+# Progress is sampled at most this often, drawing a frame is much quicker than reporting on it
+DEFAULT_TELEMETRY_INTERVAL = 1.0
+
+
+class Telemetry:
+    """
+    Structured events about renders, written as JSON lines to `path` and/or passed to `callback` as dicts.
+    Every event has an "event" name and the unix "time" it happened at.
+    Stage starts and ends are sent as they happen, progress within a stage is sampled at most
+    once every `interval` seconds, along with the process's RSS and the rate frames went at since the last sample.
+    Without a path or a callback, nothing is measured or sent.
+    """
+
+    def __init__(self, path=None, callback=None, interval=DEFAULT_TELEMETRY_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self._file = open(path, "a") if path else None
+        self._lock = threading.Lock()
+        self._next_sample = 0.0
+        self._last_sample = None
+
+    @property
+    def enabled(self):
+        return self._file is not None or self.callback is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+        record = {"event": event, "time": time.time(), **fields}
+        with self._lock:
+            if self._file:
+                # One line per event, flushed so it can be followed while the render runs
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+        if self.callback:
+            self.callback(record)
+
+    def stage_start(self, stage):
+        self.emit("stage_start", stage=stage)
+        self._last_sample = None
+
+    def stage_end(self, stage, seconds):
+        self.emit("stage_end", stage=stage, seconds=round(seconds, 4))
+
+    def sample(self, stage, get_fields, force=False):
+        """Send a "progress" event with the fields from `get_fields()`, if the last one was long enough ago"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now < self._next_sample and not force:
+            return
+        self._next_sample = now + self.interval
+
+        fields = get_fields()
+        frames = fields.get("frames")
+        if frames is not None and self._last_sample:
+            last_time, last_frames = self._last_sample
+            fields["frames_per_second"] = round(
+                (frames - last_frames) / max(now - last_time, 1e-9), 2
+            )
+        if frames is not None:
+            self._last_sample = (now, frames)
+        self.emit("progress", stage=stage, rss=get_rss(), **fields)
+
+
+def hit_rate(cache):
+    """Share of the lookups a cache with `hits` and `misses` counters could answer"""
+    lookups = cache.hits + cache.misses
+    return round(cache.hits / lookups, 4) if lookups else None
@@ -1,9 +1,24 @@
+import hashlib
+import json
 import operator
+import os
+import re
 import yaml
 
 LIGHT_THEME_FILE = "assets/default_theme_light.yaml"
 DARK_THEME_FILE = "assets/default_theme_dark.yaml"
 
+HEX_COLOR = re.compile(r"#[0-9a-fA-F]{6}")
+
+# Colors of each track, relative to tracks.<track>
+TRACK_COLOR_PATHS = [
+    "note.color",
+    "chord_line.color",
+    "chord_line.border_color",
+    "ball.color",
+    "ball.stroke_color",
+]
+
 
 class AttributeDict(dict):
     """Helper class to allow for Dicts to have Dot Notation"""
@@ -16,7 +31,13 @@ class AttributeDict(dict):
                 self.__dict__[key] = value
         super().__init__(**kwargs)
 
-    __getattr__ = dict.__getitem__
+    def __getattr__(self, key):
+        # Missing keys must raise AttributeError, so that Themes can be pickled for worker processes
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
@@ -30,6 +51,10 @@ class AttributeDict(dict):
         return None
 
 
+class ThemeError(ValueError):
+    pass
+
+
 class Theme:
     def __init__(
         self,
@@ -37,7 +62,10 @@ class Theme:
         defaults_file,
     ):
         with open(theme_file, "r") as stream:
-            self._theme = AttributeDict(**yaml.safe_load(stream))
+            try:
+                self._theme = AttributeDict(**(yaml.safe_load(stream) or {}))
+            except (yaml.YAMLError, TypeError) as e:
+                raise ThemeError(f"{theme_file} is not a valid theme: {e}")
 
         with open(defaults_file, "r") as stream:
             try:
@@ -55,6 +83,59 @@ class Theme:
                 return theme_default
             return self._defaults.get_path(default_path)
 
+    @property
+    def fingerprint(self):
+        """Changes whenever anything in the theme or its defaults does"""
+        contents = json.dumps(
+            [self._theme, self._defaults], sort_keys=True, default=str
+        )
+        return hashlib.sha256(contents.encode()).hexdigest()
+
+    def validate(self):
+        """Raise a ThemeError for mistakes that would otherwise only show up part way through a render"""
+        for name in ["width", "height", "frame_rate", "dpi", "blur_radius_resolution"]:
+            value = getattr(self, name)
+            if (
+                isinstance(value, bool)
+                or not isinstance(value, (int, float))
+                or value <= 0
+            ):
+                raise ThemeError(f"{name} must be a positive number, not {value!r}")
+
+        if self.nodes_sorted:
+            if str(self.graphviz_engine).lower() != "circo":
+                raise ThemeError(
+                    "Node sorting only works when graphviz engine is circo"
+                )
+            if not isinstance(self.nodes_sorted, bool) and not all(
+                isinstance(n, int) and 1 <= n <= 12 for n in self.nodes_sorted
+            ):
+                raise ThemeError(
+                    "nodes_sorted must be true, false or a list of 1 to 12"
+                )
+
+        if not self.hide_letters and not os.path.isfile(self.font):
+            raise ThemeError(f"Font file not found: {self.font}")
+        if self.background_image and not os.path.isfile(self.background_image):
+            raise ThemeError(f"Background image not found: {self.background_image}")
+
+        color_paths = [
+            "background_color",
+            "graph_line_color",
+            "node.fill_color",
+            "node.outline_color",
+            "node.shadow_color",
+            "node.text.color",
+            "node.text.stroke_color",
+        ]
+        tracks = set(self._theme.get("tracks") or {}) | {"default"}
+        for track in sorted(tracks):
+            color_paths += [f"tracks.{track}.{path}" for path in TRACK_COLOR_PATHS]
+        for path in color_paths:
+            color = self._get_value(path, path)
+            if isinstance(color, str) and color and not HEX_COLOR.fullmatch(color):
+                raise ThemeError(f"{path} must be a color like #1A2B3C, not {color!r}")
+
     @property
     def debug_show_base_image(self):
         path = "debug.show_base_image"
@@ -65,6 +146,11 @@ class Theme:
         path = "debug.max_frames"
         return self._get_value(path, path)
 
+    @property
+    def blur_radius_resolution(self):
+        path = "blur_radius_resolution"
+        return self._get_value(path, path)
+
     @property
     def frame_rate(self):
         path = "frame_rate"
@@ -151,6 +237,11 @@ class Theme:
         path = "group_notes_by_track"
         return self._get_value(path, path)
 
+    @property
+    def layer_groups(self):
+        path = "layer_groups"
+        return self._get_value(path, path)
+
     @property
     def width(self):
         path = "width"
@@ -235,6 +326,22 @@ class Theme:
     def tracks(self):
         return list(self._theme.tracks.keys())
 
+    def track_style(self, track):
+        """Everything that changes how a track's animations are drawn"""
+        return (
+            self.note_color(track),
+            self.note_stroke_width(track),
+            self.note_increase_size(track),
+            self.chord_line_width(track),
+            self.chord_line_color(track),
+            self.chord_line_border_color(track),
+            self.ball_radius(track),
+            self.ball_g_blur_max(track),
+            self.ball_color(track),
+            self.ball_stroke_color(track),
+            self.ball_stroke_width(track),
+        )
+
     def note_num_frames(self, track):
         a = self._get_value(
             f"tracks.{track}.note.num_frames",
@@ -1,71 +1,186 @@
 from contextlib import contextmanager
+import hashlib
+import json
 import os
+import subprocess
 import time
-
-import click
-import imageio
-import numpy as np
-from moviepy.editor import VideoFileClip, AudioFileClip
-from pydub import AudioSegment
+from uuid import uuid4
 
 from src.midi_stuff import convert_midi_to_wav
-from src.cache_stuff import get_cache_dir, cleanup_cache_dir, get_music_cache_dir
+from src.cache_stuff import (
+    atomic_write_path,
+    file_signature,
+    get_cache_dir,
+    get_music_cache_dir,
+)
+from src.encoder_stuff import (
+    MultiEncoder,
+    ScaledEncoder,
+    create_encoder,
+    get_ffmpeg_exe,
+)
+from src.options_stuff import VIDEO_FILE_ENCODERS
+
+
+def resolution_suffix(resolution, resolutions):
+    """Tells the outputs of a render apart, when there is more than one"""
+    if len(resolutions) == 1:
+        return ""
+    width, height = resolution
+    return f"_{width}x{height}"
 
 
 @contextmanager
-def initialize_video_writer(frame_rate):
-    video_file_path = f"{get_cache_dir()}/video.mp4"
-    writer = imageio.get_writer(video_file_path, fps=frame_rate)
+def initialize_video_writer(
+    frame_rate,
+    size,
+    encoder="ffmpeg",
+    output_path=None,
+    resolutions=None,
+    **encoder_options,
+):
+    """
+    Yields a writer for frames of `size`, and the path written for each of the output `resolutions`.
+    Frames are scaled down for the resolutions smaller than `size`.
+    """
+    resolutions = resolutions or [size]
+    writers = []
+    try:
+        for resolution in resolutions:
+            suffix = resolution_suffix(resolution, resolutions)
+            if encoder in VIDEO_FILE_ENCODERS:
+                # The video is written to the cache first, the music gets added in `finalize_video_with_music`
+                path = f"{get_cache_dir()}/video{suffix}.mp4"
+            else:
+                path = output_path and f"{output_path}{suffix}"
+            writer = create_encoder(
+                encoder,
+                resolution,
+                frame_rate,
+                output_path=path,
+                **encoder_options,
+            )
+            if tuple(resolution) != tuple(size):
+                writer = ScaledEncoder(writer, size)
+            writers.append(writer)
+    except Exception:
+        for writer in writers:
+            writer.close()
+        raise
+
+    writer = writers[0] if len(writers) == 1 else MultiEncoder(writers)
+    output_paths = {
+        tuple(resolution): output.output_path
+        for resolution, output in zip(resolutions, writers)
+    }
     try:
-        yield writer, video_file_path
+        yield writer, output_paths
     finally:
         writer.close()
 
 
 def add_frame_to_video(writer, frame):
-    writer.append_data(np.array(frame))
+    writer.write_frame(frame)
+
+
+# Bump this whenever the way the music is synthesized or encoded changes
+MUSIC_CACHE_VERSION = 1
+MUSIC_SAMPLE_RATE = 44100
+MUSIC_BITRATE = "192k"
+
+
+def _get_music_cache_filename(soundfont_file):
+    # The same song sounds different with another sound font, or once the sound font is edited
+    params_str = json.dumps(
+        [
+            MUSIC_CACHE_VERSION,
+            file_signature(soundfont_file),
+            MUSIC_SAMPLE_RATE,
+            MUSIC_BITRATE,
+        ]
+    )
+    params_hash = hashlib.md5(params_str.encode()).hexdigest()
+    return f"music_v{MUSIC_CACHE_VERSION}_{params_hash}.m4a"
+
+
+def prepare_music(midi_file_path, soundfont_file):
+    """
+    Synthesize the song and encode it to AAC, once per MIDI file and sound font, returns the path of the audio file.
+    Runs in the background while the frames are being drawn.
+    """
+    music_cache_dir = get_music_cache_dir(midi_file_path)
+    music_file = os.path.join(
+        music_cache_dir, _get_music_cache_filename(soundfont_file)
+    )
+    if os.path.exists(music_file):
+        return music_file
+
+    # Renders of the same song can run at the same time, each synthesizes into its own file
+    temp_music_file = os.path.join(music_cache_dir, f"{uuid4()}.wav")
+    try:
+        convert_midi_to_wav(
+            midi_file_path, temp_music_file, soundfont_file, MUSIC_SAMPLE_RATE
+        )
+        with atomic_write_path(music_file, suffix=".m4a") as temp_path:
+            subprocess.run(
+                [
+                    get_ffmpeg_exe(),
+                    "-y",
+                    "-loglevel",
+                    "error",
+                    "-i",
+                    temp_music_file,
+                    "-c:a",
+                    "aac",
+                    "-b:a",
+                    MUSIC_BITRATE,
+                    temp_path,
+                ],
+                check=True,
+            )
+    finally:
+        if os.path.exists(temp_music_file):
+            os.remove(temp_music_file)
+    return music_file
 
 
 def finalize_video_with_music(
     writer,
     video_file_path,
     output_file_name,
-    midi_file_path,
+    music_file,
     frame_rate,
-    soundfont_file,
     frames_written,
 ):
+    """
+    Add the music to the video, cut to the length of the video.
+    Both are already encoded, so they are only copied into the final file, however long the song is.
+    """
     writer.close()  # Ensure the writer is closed
 
-    # Audio processing
-    temp_music_file = os.path.join(get_music_cache_dir(midi_file_path), "temp_music.wav")
-    click.echo("Converting midi to wave...")
-
-    if not os.path.exists(temp_music_file):
-        open(temp_music_file, "ab").close()
-        convert_midi_to_wav(
-            midi_file_path,
-            temp_music_file,
-            soundfont_file,
-        )
-    audio_clip = AudioSegment.from_file(temp_music_file)
-
-    audio_duration = int(
-        (frames_written / frame_rate) * 1000
-    )  # Duration in milliseconds
-    audio_clip = audio_clip[:audio_duration]  # Truncate the audio
-
-    temp_audio = f"{get_music_cache_dir(midi_file_path)}/music.wav"
-    audio_clip.export(temp_audio, format="wav")
-
-    final_video = VideoFileClip(video_file_path)
-    final_video_audio = AudioFileClip(temp_audio)
-    final_video = final_video.set_audio(final_video_audio)
-
     timestamp = int(time.time())
     final_output_path = f"{output_file_name}_{timestamp}.mp4"
-    final_video.write_videofile(final_output_path, codec="libx264", audio_codec="aac")
-
-    cleanup_cache_dir(get_cache_dir())
+    subprocess.run(
+        [
+            get_ffmpeg_exe(),
+            "-y",
+            "-loglevel",
+            "error",
+            "-i",
+            video_file_path,
+            "-i",
+            music_file,
+            "-map",
+            "0:v",
+            "-map",
+            "1:a",
+            "-c",
+            "copy",
+            "-t",
+            f"{frames_written / frame_rate:.3f}",
+            final_output_path,
+        ],
+        check=True,
+    )
 
     return final_output_path
@@ -0,0 +1,47 @@
+import random
+
+from src.animation_stuff import FRAMES_PER_BUCKET, AnimationFrames
+from src.memory_stuff import PLAN_BYTES_PER_ANIMATION
+
+
+def _draw(frame_number, **kwargs):
+    pass
+
+
+def _plan(frames, seed=0):
+    """Add animations in the order a planner would, telling `frames` how far planning has got"""
+    rng = random.Random(seed)
+    sizes = []
+    for start_frame in range(0, 3000, 7):
+        for layer in range(rng.randrange(1, 4)):
+            length = rng.randrange(1, 200)
+            frames.add_animation(f"l{layer}", start_frame, length, _draw, {"x": layer})
+        frames.planned_until(start_frame)
+        sizes.append(frames.estimated_size)
+    return sizes
+
+
+def test_finished_buckets_are_spilled_while_planning(tmp_path):
+    expected = AnimationFrames()
+    _plan(expected)
+
+    frames = AnimationFrames()
+    threshold = 100 * 1024
+    frames.spill_as_planned(str(tmp_path), lambda plan: plan.estimated_size > threshold)
+    sizes = _plan(frames)
+
+    # The plan in memory stays around the threshold instead of growing with the song
+    assert max(sizes) < 2 * threshold < expected.estimated_size
+    assert len(list(tmp_path.iterdir())) > 3000 // FRAMES_PER_BUCKET // 2
+    assert frames.num_animations == expected.num_animations
+    assert len(frames) == len(expected)
+    for frame_index in range(len(expected) + 1):
+        assert frames.frame(frame_index) == expected.frame(frame_index)
+
+
+def test_nothing_is_spilled_under_the_threshold(tmp_path):
+    frames = AnimationFrames()
+    frames.spill_as_planned(str(tmp_path), lambda plan: False)
+    _plan(frames)
+    assert list(tmp_path.iterdir()) == []
+    assert frames.estimated_size == frames.num_animations * PLAN_BYTES_PER_ANIMATION
@@ -0,0 +1,97 @@
+import os
+import time
+
+from PIL import Image
+
+import src.cache_stuff
+import src.video_stuff
+from src.cache_stuff import trim_cache_dir
+from src.generate_music_graph import load_layout, save_layout
+from src.graph_stuff import Draw
+
+
+def _write(path, size, mtime):
+    path.write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_least_recently_used_entries_are_removed(tmp_path):
+    now = time.time()
+    _write(tmp_path / "old.npy", 60, now - 30)
+    _write(tmp_path / "old.json", 10, now - 30)
+    # Used recently, through its index
+    _write(tmp_path / "used.npy", 60, now - 20)
+    _write(tmp_path / "used.json", 10, now)
+    _write(tmp_path / "new.npy", 60, now - 10)
+    _write(tmp_path / "new.json", 10, now - 10)
+    # Being written by another process
+    _write(tmp_path / "other.npy.1234.tmp", 500, now - 100)
+
+    trim_cache_dir(str(tmp_path), 150, keep={"new"})
+    assert sorted(os.listdir(tmp_path)) == [
+        "new.json",
+        "new.npy",
+        "other.npy.1234.tmp",
+        "used.json",
+        "used.npy",
+    ]
+
+    # The kept entry stays even when it alone is over the size
+    trim_cache_dir(str(tmp_path), 0, keep={"new"})
+    assert sorted(os.listdir(tmp_path)) == ["new.json", "new.npy", "other.npy.1234.tmp"]
+
+
+def test_layouts_load_as_they_were_saved(tmp_path):
+    base_image = Image.new("RGBA", (8, 6), (10, 20, 30, 255))
+    base_image.putpixel((3, 2), (1, 2, 3, 4))
+    node = Draw("black", "white", None, None, [1.5, 2.25, 3.0, 4.0])
+    edge = Draw("black", None, None, [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8], None)
+    self_edge = Draw("black", None, None, [1.0] * 8, None)
+    nodes = {"1-60": node, "1-64": node}
+    edges = {
+        "1-60": {"1-64": edge, "1-60": self_edge},
+        "1-64": {"1-60": edge},
+    }
+    path = str(tmp_path / "layout")
+    save_layout(path, (base_image, nodes, edges, (5, 7)))
+
+    loaded_image, loaded_nodes, loaded_edges, offsets = load_layout(path)
+    assert loaded_image.mode == "RGBA"
+    assert loaded_image.tobytes() == base_image.tobytes()
+    assert loaded_nodes == nodes
+    assert loaded_edges == edges
+    assert offsets == (5, 7)
+
+    assert load_layout(str(tmp_path / "missing")) is None
+
+
+def test_music_is_synthesized_again_for_another_sound_font(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.cache_stuff, "_music_cache_base_dir", str(tmp_path))
+    synthesized = []
+
+    def _synthesize(midi_file_path, wav_file_path, soundfont, sample_rate):
+        synthesized.append(soundfont)
+        open(wav_file_path, "wb").close()
+
+    def _encode(command, check):
+        open(command[-1], "wb").close()
+
+    monkeypatch.setattr(src.video_stuff, "convert_midi_to_wav", _synthesize)
+    monkeypatch.setattr(src.video_stuff, "get_ffmpeg_exe", lambda: "ffmpeg")
+    monkeypatch.setattr(src.video_stuff.subprocess, "run", _encode)
+    midi = tmp_path / "song.mid"
+    midi.write_bytes(b"MThd")
+    soundfonts = [tmp_path / "a.sf2", tmp_path / "b.sf2"]
+    for soundfont in soundfonts:
+        soundfont.write_bytes(b"sf")
+    first, second = (str(soundfont) for soundfont in soundfonts)
+
+    music_file = src.video_stuff.prepare_music(str(midi), first)
+    assert src.video_stuff.prepare_music(str(midi), first) == music_file
+    assert src.video_stuff.prepare_music(str(midi), second) != music_file
+    assert synthesized == [first, second]
+
+    # Editing the sound font makes its music stale too
+    soundfonts[0].write_bytes(b"edited")
+    assert src.video_stuff.prepare_music(str(midi), first) != music_file
+    assert synthesized == [first, second, first]
@@ -0,0 +1,153 @@
+import json
+import os
+import signal
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+import src.cache_stuff
+import src.daemon_stuff
+import src.estimate_stuff
+import src.frame_cache_stuff
+from src.daemon_stuff import RenderService, create_server
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    # Every cache goes to the test's directory. They are set in the environment too,
+    # for workers that import the modules afresh
+    for module, name, env, path in [
+        (src.cache_stuff, "_cache_base_dir", "MUSIC_GRAPHS_CACHE", "cache"),
+        (
+            src.cache_stuff,
+            "_music_cache_base_dir",
+            "MUSIC_GRAPHS_MUSIC_CACHE",
+            "music_cache",
+        ),
+        (
+            src.cache_stuff,
+            "_layout_cache_dir",
+            "MUSIC_GRAPHS_LAYOUT_CACHE",
+            "layout_cache",
+        ),
+        (
+            src.frame_cache_stuff,
+            "_frame_cache_dir",
+            "MUSIC_GRAPHS_FRAME_CACHE",
+            "frame_cache",
+        ),
+        (
+            src.estimate_stuff,
+            "_cost_model_path",
+            "MUSIC_GRAPHS_COST_MODEL",
+            "cost_model.json",
+        ),
+    ]:
+        monkeypatch.setenv(env, str(tmp_path / path))
+        monkeypatch.setattr(module, name, str(tmp_path / path))
+    # The default themes are relative to the repo
+    for name in ["LIGHT_THEME_FILE", "DARK_THEME_FILE"]:
+        monkeypatch.setattr(
+            src.daemon_stuff,
+            name,
+            os.path.join(REPO_DIR, getattr(src.daemon_stuff, name)),
+        )
+    service = RenderService(num_workers=1)
+    server = create_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def _request(url, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(url, data=data, timeout=10) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def test_malformed_jobs_are_rejected(daemon, tmp_path):
+    midi = tmp_path / "song.mid"
+    midi.write_bytes(b"MThd")
+
+    for body in [
+        {},
+        {"midi": str(tmp_path / "missing.mid")},
+        {"midi": str(midi), "priority": "high"},
+        {"midi": str(midi), "priority": True},
+        {"midi": str(midi), "crf": [23]},
+        {"midi": str(midi), "theme": 1},
+        {"midi": str(midi), "resolutions": "540x960"},
+        {"midi": str(midi), "encoder": "y4m"},
+    ]:
+        status, response = _request(f"{daemon}/jobs", body)
+        assert status == 400, body
+        assert response["error"]
+
+    assert _request(f"{daemon}/jobs/1") == (404, {"error": "No such job"})
+    assert _request(f"{daemon}/stats")[1]["queued"] == 0
+
+
+def _wait_for(daemon, job):
+    deadline = time.monotonic() + 60
+    while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.1)
+        _, job = _request(f"{daemon}/jobs/{job['id']}")
+    return job
+
+
+def test_failed_jobs_report_their_error(daemon, tmp_path):
+    midi = tmp_path / "song.mid"
+    midi.write_bytes(b"not a MIDI file")
+
+    status, job = _request(
+        f"{daemon}/jobs", {"midi": str(midi), "encoder": "png", "priority": 2}
+    )
+    assert status == 202
+    assert (job["id"], job["priority"], job["status"]) == ("1", 2, "queued")
+
+    job = _wait_for(daemon, job)
+    assert job["status"] == "failed"
+    assert "is not a MIDI file" in job["error"]
+
+    stats = _request(f"{daemon}/stats")[1]
+    assert stats["queued"] == stats["running"] == stats["done"] == 0
+    assert stats["failed"] == 1
+
+
+def test_jobs_run_again_after_a_worker_dies(daemon, tmp_path):
+    midi = tmp_path / "song.mid"
+    midi.write_bytes(b"not a MIDI file")
+
+    _, job = _request(f"{daemon}/jobs", {"midi": str(midi), "encoder": "png"})
+    job = _wait_for(daemon, job)
+    deadline = time.monotonic() + 10
+    while job["worker_pid"] is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+        _, job = _request(f"{daemon}/jobs/{job['id']}")
+
+    # Like a worker killed for running out of memory
+    os.kill(job["worker_pid"], signal.SIGKILL)
+
+    _, job = _request(f"{daemon}/jobs", {"midi": str(midi), "encoder": "png"})
+    job = _wait_for(daemon, job)
+    assert job["status"] == "failed"
+    assert "terminated abruptly" in job["error"]
+
+    _, job = _request(f"{daemon}/jobs", {"midi": str(midi), "encoder": "png"})
+    job = _wait_for(daemon, job)
+    assert job["status"] == "failed"
+    assert "is not a MIDI file" in job["error"]
+
+    stats = _request(f"{daemon}/stats")[1]
+    assert stats["running"] == 0
+    assert stats["failed"] == 3
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+
+from src.frame_cache_stuff import FrameCache
+from src.frame_stuff import FrameCompositor
+from src.theme_stuff import DARK_THEME_FILE, Theme
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _theme(tmp_path, name, track_1_color):
+    path = tmp_path / f"{name}.yaml"
+    path.write_text(
+        "tracks:\n"
+        "  track_1:\n"
+        "    note:\n"
+        f'      color: "{track_1_color}"\n'
+        "  track_2:\n"
+        "    note:\n"
+        '      color: "#00ff00"\n'
+    )
+    return Theme(str(path), os.path.join(REPO_DIR, DARK_THEME_FILE))
+
+
+def _draw_note(theme, offsets, x, track):
+    pass
+
+
+def _draw(compositor, x):
+    compositor.reset()
+    patch = np.zeros((4, 4, 4), dtype=np.uint8)
+    patch[..., :] = (x, 2 * x, 3 * x, 255)
+    compositor.blend(patch, (x, x))
+
+
+def test_frames_are_loaded_as_they_were_drawn(tmp_path):
+    theme = _theme(tmp_path, "theme", "#ff0000")
+    base_frame = np.full((32, 32, 4), 7, dtype=np.uint8)
+    cache = FrameCache(theme, base_frame, (0, 0), 1 << 20, str(tmp_path))
+    compositor = FrameCompositor(base_frame)
+
+    draw_list = [(_draw_note, {"x": 3, "track": "track_1"})]
+    key = cache.key(draw_list)
+    assert not cache.load(key, compositor)
+    _draw(compositor, 3)
+    cache.store(key, compositor)
+    drawn = compositor.frame.copy()
+
+    # Another render, with its own cache on the same directory
+    cache = FrameCache(theme, base_frame, (0, 0), 1 << 20, str(tmp_path))
+    compositor = FrameCompositor(base_frame)
+    compositor.reset()
+    assert cache.load(cache.key(draw_list), compositor)
+    np.testing.assert_array_equal(compositor.frame, drawn)
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_only_frames_of_changed_tracks_are_redrawn(tmp_path):
+    base_frame = np.zeros((32, 32, 4), dtype=np.uint8)
+    red = FrameCache(
+        _theme(tmp_path, "red", "#ff0000"), base_frame, (0, 0), 1 << 20, str(tmp_path)
+    )
+    blue = FrameCache(
+        _theme(tmp_path, "blue", "#0000ff"), base_frame, (0, 0), 1 << 20, str(tmp_path)
+    )
+
+    track_1 = [(_draw_note, {"x": 3, "track": "track_1"})]
+    track_2 = [(_draw_note, {"x": 3, "track": "track_2"})]
+    assert red.key(track_1) != blue.key(track_1)
+    assert red.key(track_2) == blue.key(track_2)
+    assert red.key(track_2) != red.key([(_draw_note, {"x": 4, "track": "track_2"})])
+
+
+def test_least_recently_used_frames_are_removed(tmp_path):
+    theme = _theme(tmp_path, "theme", "#ff0000")
+    base_frame = np.zeros((32, 32, 4), dtype=np.uint8)
+    compositor = FrameCompositor(base_frame)
+    cache = FrameCache(theme, base_frame, (0, 0), 1 << 20, str(tmp_path))
+    keys = []
+    for x in range(4):
+        keys.append(cache.key([(_draw_note, {"x": x, "track": "track_1"})]))
+        _draw(compositor, x)
+        cache.store(keys[-1], compositor)
+    frame_size = os.path.getsize(os.path.join(str(tmp_path), f"{keys[-1]}.frame"))
+
+    # Using the first frame keeps it around
+    compositor.reset()
+    assert cache.load(keys[0], compositor)
+    cache.max_bytes = frame_size * 2
+    _draw(compositor, 5)
+    cache.store(cache.key([(_draw_note, {"x": 5, "track": "track_1"})]), compositor)
+
+    cached = {
+        name[: -len(".frame")]
+        for name in os.listdir(str(tmp_path))
+        if name.endswith(".frame")
+    }
+    assert len(cached) == 2
+    assert keys[0] in cached
+    assert not cached & set(keys[1:])
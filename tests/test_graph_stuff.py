@@ -0,0 +1,22 @@
+from src.graph_stuff import EllipseMaskCache
+from src.memory_stuff import MemoryBudget
+
+
+def test_ellipse_masks_stay_within_their_budget():
+    masks = EllipseMaskCache(
+        max_bytes=MemoryBudget(64 * 100 * 100).ellipse_mask_bytes(1 << 30)
+    )
+    assert masks.max_bytes == 4 * 100 * 100
+
+    first = masks.get((100, 100), (10, 10, 90, 90), 2.0)
+    assert masks.get((100, 100), (10, 10, 90, 90), 2.0) is first
+    for radius in [3.0, 4.0, 5.0, 6.0]:
+        masks.get((100, 100), (10, 10, 90, 90), radius)
+    assert masks.total_bytes == 4 * 100 * 100
+
+    # The least recently used mask was dropped, and is blurred again
+    assert masks.get((100, 100), (10, 10, 90, 90), 2.0) is not first
+    assert masks.total_bytes <= masks.max_bytes
+
+    masks.resize(0)
+    assert masks.total_bytes == 0
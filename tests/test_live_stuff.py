@@ -0,0 +1,88 @@
+import os
+from collections import defaultdict
+
+from PIL import Image
+
+import src.generate_music_graph
+import src.live_stuff
+from src.animation_stuff import FRAMES_PER_BUCKET
+from src.generate_music_graph import create_graphviz_sorted
+from src.graph_stuff import Draw
+from src.live_stuff import (
+    CIRCLE_OF_FIFTHS,
+    LIVE_TRACK_NUMBER,
+    LiveRenderer,
+    NoteEvent,
+)
+from src.midi_stuff import get_note
+from src.theme_stuff import DARK_THEME_FILE, Theme
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _live_layout(theme):
+    """Nodes on a row, instead of laying them out with Graphviz"""
+    notes = [get_note(LIVE_TRACK_NUMBER, number - 1) for number in CIRCLE_OF_FIFTHS]
+    nodes = {
+        note: Draw(None, None, None, None, [10.0 + 10 * i, 20.0, 4.0, 4.0])
+        for i, note in enumerate(notes)
+    }
+    edges = defaultdict(dict)
+    for a in notes:
+        for b in notes:
+            xa, xb = nodes[a].e_points[0], nodes[b].e_points[0]
+            edges[a][b] = Draw(
+                None, None, None, [xa, 20.0, xa, 30.0, xb, 30.0, xb, 20.0], None
+            )
+    base_image = Image.new("RGBA", (theme.width, theme.height), (0, 0, 0, 255))
+    return base_image, nodes, edges, (0, 0)
+
+
+def _renderer(tmp_path, monkeypatch):
+    monkeypatch.setattr(src.live_stuff, "create_live_layout", _live_layout)
+    path = tmp_path / "theme.yaml"
+    path.write_text("width: 160\nheight: 48\nframe_rate: 30\n")
+    return LiveRenderer(Theme(str(path), os.path.join(REPO_DIR, DARK_THEME_FILE)))
+
+
+def test_late_frames_are_filled_in_with_the_last_frame(tmp_path, monkeypatch):
+    renderer = _renderer(tmp_path, monkeypatch)
+    frame_rate = renderer.theme.frame_rate
+    # Every frame takes as long as 3 frames to draw
+    clock = lambda: renderer.frames_drawn * 3 / frame_rate
+
+    events = [NoteEvent(60 + i % 12, 100, i * 0.25) for i in range(40)]
+    written = []
+    renderer.run(events, lambda index, frame: written.append(index), clock=clock)
+
+    # The stream never skips a frame, even though most of them weren't drawn
+    assert written == list(range(len(written)))
+    assert renderer.frames_skipped > renderer.frames_drawn
+    assert renderer.frames_drawn + renderer.frames_skipped == len(written)
+    # Old buckets were dropped, even when the frame starting them was skipped
+    assert len(written) > 3 * FRAMES_PER_BUCKET
+    assert min(renderer.frames._buckets) >= written[-1] // FRAMES_PER_BUCKET - 1
+
+
+def test_live_layout_goes_around_the_circle_in_the_given_order(tmp_path, monkeypatch):
+    circles = []
+
+    def _node_positions(graph):
+        circles.append(
+            [line.split()[0].strip('"') for line in graph.body if "--" not in line]
+        )
+        return {name: f"{i},0!" for i, name in enumerate(circles[-1])}
+
+    monkeypatch.setattr(src.generate_music_graph, "get_node_positions", _node_positions)
+    # A theme that would sort the nodes chromatically, with an engine that can't
+    path = tmp_path / "theme.yaml"
+    path.write_text('graphviz_engine: "neato"\nnodes_sorted: true\n')
+    theme = Theme(str(path), os.path.join(REPO_DIR, DARK_THEME_FILE))
+
+    nodes = [get_note(LIVE_TRACK_NUMBER, number - 1) for number in range(1, 13)]
+    graph = create_graphviz_sorted(theme, nodes, nodes, {}, order=CIRCLE_OF_FIFTHS)
+
+    circle = [get_note(LIVE_TRACK_NUMBER, number - 1) for number in CIRCLE_OF_FIFTHS]
+    assert circles == [circle + [circle[0]]]
+    assert graph.engine == "neato"
+    assert all("pos=" in line for line in graph.body if "--" not in line)
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+import music_graphs
+from src.options_stuff import check_resolutions
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_resolutions_are_sorted_and_deduplicated():
+    resolutions = [(272, 480), (1088, 1920), (544, 960), (272, 480)]
+    assert check_resolutions(resolutions, (1088, 1920), "ffmpeg") == [
+        (1088, 1920),
+        (544, 960),
+        (272, 480),
+    ]
+
+
+@pytest.mark.parametrize("resolution", [(545, 962), (544, 961)])
+def test_video_files_need_even_sides(resolution):
+    with pytest.raises(ValueError, match="odd side"):
+        check_resolutions([resolution], (1088, 1920), "ffmpeg")
+    # Frames written as images don't go through YUV 4:2:0
+    assert check_resolutions([resolution], (1088, 1920), "png") == [resolution]
+
+
+def test_odd_resolutions_are_rejected_on_the_command_line(tmp_path, monkeypatch):
+    midi = tmp_path / "song.mid"
+    midi.write_bytes(b"MThd")
+    monkeypatch.chdir(REPO_DIR)
+    result = CliRunner().invoke(
+        music_graphs.main, ["--midi", str(midi), "--resolution", "545x962"]
+    )
+    assert result.exit_code == 2
+    assert "Invalid value for '--resolution'" in result.output
+    assert "odd side" in result.output
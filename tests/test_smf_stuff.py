@@ -0,0 +1,202 @@
+import random
+import warnings
+
+import numpy as np
+import pytest
+
+from src.smf_stuff import MidiFileError, read_midi_notes
+
+# The notes are checked against pretty_midi, which the parser replaced
+mido = pytest.importorskip("mido")
+pretty_midi = pytest.importorskip("pretty_midi")
+
+
+def _variable_length(value):
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+
+def _event(delta, *data):
+    return _variable_length(delta) + bytes(data)
+
+
+def _tempo(delta, microseconds_per_beat):
+    return _event(delta, 0xFF, 0x51, 3) + microseconds_per_beat.to_bytes(3, "big")
+
+
+def _write_midi(path, tracks, ticks_per_beat=480):
+    """Write raw track events as is, so the tests control running status and event order"""
+    data = b"MThd" + (6).to_bytes(4, "big")
+    data += (1).to_bytes(2, "big") + len(tracks).to_bytes(2, "big")
+    data += ticks_per_beat.to_bytes(2, "big")
+    for events in tracks:
+        track = b"".join(events) + _event(0, 0xFF, 0x2F, 0)
+        data += b"MTrk" + len(track).to_bytes(4, "big") + track
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _assert_same_notes(path):
+    with warnings.catch_warnings():
+        # pretty_midi warns about tempo changes outside of the first track, and ignores them
+        warnings.simplefilter("ignore")
+        expected = pretty_midi.PrettyMIDI(str(path)).instruments
+    notes = read_midi_notes(str(path))
+
+    assert len(notes) == len(expected)
+    for (starts, ends, pitches, velocities), instrument in zip(notes, expected):
+        np.testing.assert_allclose(starts, [n.start for n in instrument.notes])
+        np.testing.assert_allclose(ends, [n.end for n in instrument.notes])
+        assert pitches.tolist() == [n.pitch for n in instrument.notes]
+        assert velocities.tolist() == [n.velocity for n in instrument.notes]
+    return notes
+
+
+def test_running_status(tmp_path):
+    path = _write_midi(
+        tmp_path / "running_status.mid",
+        [
+            [
+                _event(0, 0x90, 60, 100),
+                _event(0, 64, 90),
+                _event(240, 67, 80),
+                _event(240, 0x80, 60, 0),
+                _event(0, 64, 0),
+                _event(480, 67, 0),
+            ]
+        ],
+    )
+    notes = _assert_same_notes(path)
+    assert sum(len(pitches) for _, _, pitches, _ in notes) == 3
+
+
+def test_note_on_with_velocity_zero(tmp_path):
+    path = _write_midi(
+        tmp_path / "velocity_zero.mid",
+        [
+            [
+                _event(0, 0x91, 60, 100),
+                _event(480, 0x91, 60, 0),
+                _event(0, 0x91, 62, 100),
+                # Running status note ons with velocity 0
+                _event(480, 62, 0),
+                _event(0, 64, 100),
+                _event(480, 64, 0),
+            ]
+        ],
+    )
+    _assert_same_notes(path)
+
+
+def test_overlapping_notes_on_the_same_tick(tmp_path):
+    path = _write_midi(
+        tmp_path / "overlapping.mid",
+        [
+            [
+                # Two notes on the same pitch, closed by a single note off
+                _event(0, 0x90, 60, 100),
+                _event(120, 0x90, 60, 90),
+                _event(120, 0x80, 60, 0),
+                # A note off and a new note on the same pitch at the same tick, in both orders
+                _event(0, 0x90, 62, 100),
+                _event(240, 0x80, 62, 0),
+                _event(0, 0x90, 62, 70),
+                _event(240, 0x90, 64, 100),
+                _event(0, 0x80, 62, 0),
+                _event(240, 0x90, 64, 60),
+                _event(0, 0x80, 64, 0),
+                _event(240, 0x80, 64, 0),
+                # A note on and off at the same tick is kept playing until the next note off
+                _event(0, 0x90, 65, 100),
+                _event(0, 0x80, 65, 0),
+                _event(240, 0x80, 65, 0),
+                # Spurious note off
+                _event(0, 0x80, 67, 0),
+            ]
+        ],
+    )
+    _assert_same_notes(path)
+
+
+def test_tempo_changes(tmp_path):
+    path = _write_midi(
+        tmp_path / "tempo_changes.mid",
+        [
+            [_tempo(0, 400000), _tempo(960, 600000), _tempo(960, 300000)],
+            [
+                _event(0, 0xC0, 40),
+                _event(0, 0x90, 60, 100),
+                _event(1200, 0x80, 60, 0),
+                # A tempo change outside of the first track, which doesn't count
+                _tempo(300, 1000000),
+                _event(0, 0x90, 62, 100),
+                _event(960, 0x80, 62, 0),
+                _event(0, 0xC0, 41),
+                _event(0, 0x90, 64, 100),
+                _event(480, 0x80, 64, 0),
+            ],
+        ],
+    )
+    notes = _assert_same_notes(path)
+    # The program change starts a new instrument
+    assert len(notes) == 2
+
+
+def test_random_song(tmp_path):
+    rng = random.Random(0)
+    midi = mido.MidiFile(ticks_per_beat=96)
+    for track_index in range(3):
+        events = []
+        if track_index == 0:
+            for tick in range(0, 9600, 1200):
+                tempo = rng.randint(300000, 900000)
+                events.append((tick, mido.MetaMessage("set_tempo", tempo=tempo)))
+        for _ in range(200):
+            channel = rng.choice([0, 1, 9])
+            note = rng.randrange(40, 80)
+            start = rng.randrange(9600)
+            end = start + rng.randrange(0, 300)
+            velocity = rng.randint(1, 127)
+            events.append(
+                (
+                    start,
+                    mido.Message(
+                        "note_on", channel=channel, note=note, velocity=velocity
+                    ),
+                )
+            )
+            # Half of the notes end with a note on with velocity 0
+            kind, velocity = rng.choice([("note_on", 0), ("note_off", 64)])
+            events.append(
+                (end, mido.Message(kind, channel=channel, note=note, velocity=velocity))
+            )
+        program = rng.randrange(128)
+        events.append(
+            (
+                rng.randrange(9600),
+                mido.Message("program_change", channel=1, program=program),
+            )
+        )
+
+        track = mido.MidiTrack()
+        tick = 0
+        for event_tick, message in sorted(events, key=lambda event: event[0]):
+            track.append(message.copy(time=event_tick - tick))
+            tick = event_tick
+        midi.tracks.append(track)
+
+    path = tmp_path / "random.mid"
+    midi.save(str(path))
+    _assert_same_notes(path)
+
+
+def test_not_a_midi_file(tmp_path):
+    path = tmp_path / "song.mid"
+    path.write_bytes(b"RIFF")
+    with pytest.raises(MidiFileError):
+        read_midi_notes(str(path))